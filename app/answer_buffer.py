@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+KEY_COLUMNS = ("id", "guild_id")  # responses の主キー（同じユーザーでもギルドごとに別の行）
+
+
+def record_key(record: dict) -> tuple:
+    return tuple(record.get(column) for column in KEY_COLUMNS)
+
+
+# 回答をすぐにSupabaseへ書かずにバッファし、件数または時間のしきい値でまとめてupsertする。
+# 追加した回答は先にジャーナルファイルへ追記し、送信できたものだけジャーナルから消すので、
+# Supabaseが落ちていても再起動時に再送できる
+class AnswerBuffer:
+    def __init__(self, db, journal_path: str, table: str = "responses", batch_size: int = 50,
+                 flush_interval: float = 2.0, max_retries: int = 5):
+        self.db = db
+        self.journal_path = journal_path
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.pending: dict[tuple, dict] = {}  # (id, guild_id) → 回答（同じユーザー・ギルドの回答は最新で上書き）
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def add(self, record: dict):
+        self.pending[record_key(record)] = record
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    # 前回送信できなかった回答をジャーナルから読み込む
+    def replay(self) -> int:
+        if not os.path.exists(self.journal_path):
+            return 0
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.pending[record_key(record)] = record
+        return len(self.pending)
+
+    def _rewrite_journal(self):
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self.pending.values():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.journal_path)
+
+    async def _upsert_with_retry(self, rows: list[dict]):
+        for attempt in range(self.max_retries):
+            try:
+                await self.db.execute(
+                    "store_answers", lambda c: c.table(self.table).upsert(rows, on_conflict=",".join(KEY_COLUMNS))
+                )
+                return
+            except Exception as e:
+                if attempt == self.max_retries - 1:
+                    raise
+                delay = 2 ** attempt
+                log.warning("⚠️ 回答の保存に失敗しました（%s秒後に再試行）: %s", delay, e, extra={"rows": len(rows)})
+                await asyncio.sleep(delay)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            batch = self.pending
+            self.pending = {}
+
+            # 回答項目が揃っていない（途中で中断した）行もあるため、列の組み合わせごとにまとめて送る
+            groups: dict[tuple, list[dict]] = {}
+            for record in batch.values():
+                groups.setdefault(tuple(sorted(record)), []).append(record)
+
+            failed = []
+            for rows in groups.values():
+                for i in range(0, len(rows), self.batch_size):
+                    chunk = rows[i:i + self.batch_size]
+                    try:
+                        await self._upsert_with_retry(chunk)
+                        log.info("✅ 回答をSupabaseに保存しました: %s 件", len(chunk), extra={"rows": len(chunk)})
+                    except Exception as e:
+                        log.error("❌ Supabase保存エラー（ジャーナルに退避）: %s", e, extra={"rows": len(chunk)})
+                        failed.extend(chunk)
+
+            # 送信中に新しい回答が来ていればそちらを優先する
+            for record in failed:
+                self.pending.setdefault(record_key(record), record)
+            self._rewrite_journal()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.exception("⚠️ 回答のフラッシュに失敗しました: %s", e)
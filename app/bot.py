@@ -4,33 +4,106 @@ from datetime import datetime
 import asyncio
 import os
 import requests
-import tempfile
-import gspread
 from dotenv import load_dotenv
 from supabase import create_client, Client
-from oauth2client.service_account import ServiceAccountCredentials
+from postgrest.exceptions import APIError
 from discord import ui
 import re
-from discord.utils import get
+import csv
+import io
+import logging
+from database import Database
+from guild_config import GuildConfig, GuildConfigStore
+from inviter_roster import InviterRosters
+from member_cache import member_cache_flags, get_or_fetch_member, members_with_role, members_with_roles, cache_members
+from invite_cache import InviteMessageCaches
+from dm_router import DMReplyRouter
+from dm_outbox import DMOutbox
+from answer_buffer import AnswerBuffer
+from questionnaire import Questionnaire, QuestionnaireDefinition, SessionStore, DYNAMIC_ITEMS
+from role_index import RoleIndex, FUNNEL_ROLE_NAMES, FUNNEL_STATES
+from throttle import Pacer, run_throttled
+from pending_avatars import PendingAvatars
+from sheets import SheetsClient
+from metrics import REGISTRY, discord_trace_config, monitor_loop_lag
+from json_logging import parse_sample_rates, setup_logging
+from invite_summary import summarize_invite_counts, build_summary_table, table_to_csv, build_summary_embed
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 TOKEN = os.getenv("DISCORD_TOKEN")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_API_KEY")
+# 以下の INVITE_URL / ADMIN_* / INVITER_* / ROLE_ID_* は guild_configs に行のないギルドの既定値
 INVITE_URL = os.getenv("INVITE_URL")
-ADMIN_USER_ID = 1353745472153583616
+ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "1353745472153583616"))
+ADMIN_CHANNEL_ID = int(os.getenv("ADMIN_CHANNEL_ID", "0")) or None  # 設定すると管理者へのDMの代わりにこのチャンネルへ通知する
+INVITE_CACHE_TTL = float(os.getenv("INVITE_CACHE_TTL", "300"))
+QUESTIONNAIRE_PATH = os.getenv("QUESTIONNAIRE_PATH", os.path.join(os.path.dirname(__file__), "questionnaire.json"))
+ANSWER_JOURNAL_PATH = os.getenv("ANSWER_JOURNAL_PATH", os.path.join(os.path.dirname(__file__), "answers_journal.jsonl"))
+ANSWER_BATCH_SIZE = int(os.getenv("ANSWER_BATCH_SIZE", "50"))
+ANSWER_FLUSH_INTERVAL = float(os.getenv("ANSWER_FLUSH_INTERVAL", "2"))
+ROLE_EDIT_WORKERS = int(os.getenv("ROLE_EDIT_WORKERS", "2"))
+ROLE_EDIT_RATE = float(os.getenv("ROLE_EDIT_RATE", "2"))  # 1秒あたりのロール変更リクエスト数
+AVATAR_RECONCILE_INTERVAL = float(os.getenv("AVATAR_RECONCILE_INTERVAL", "600"))  # 初期アイコンロールと招待者一覧の再確認の間隔
+MAX_ACTIVE_SESSIONS = int(os.getenv("MAX_ACTIVE_SESSIONS", "0"))  # 0は無制限
+INVITER_GUILD_ID = int(os.getenv("INVITER_GUILD_ID", "1361763625953398945"))  # 招待者ロールがあるサーバーID
+INVITER_ROLE_ID = int(os.getenv("INVITER_ROLE_ID", "1373499098359136256"))  # 招待者ロールID
+SUPABASE_MAX_WORKERS = int(os.getenv("SUPABASE_MAX_WORKERS", "4"))
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+SUPABASE_SLOW_MS = float(os.getenv("SUPABASE_SLOW_MS", "1000"))  # これより遅いリクエストは WARNING で記録する
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_SAMPLE_RATES = parse_sample_rates(os.getenv("LOG_SAMPLE", ""))  # 例: "questionnaire=0.1,database=0.05"
+INVITE_BULK_CHUNK_SIZE = int(os.getenv("INVITE_BULK_CHUNK_SIZE", "500"))
+SETTLE_CHUNK_SIZE = int(os.getenv("SETTLE_CHUNK_SIZE", "100"))
+INVITE_PAGE_SIZE = int(os.getenv("INVITE_PAGE_SIZE", "1000"))
+DM_RATE = float(os.getenv("DM_RATE", "40"))  # 1秒あたりのDM関連リクエスト数（送信とチャンネル作成の合計。Discordのグローバル上限は50）
+DM_WORKERS = int(os.getenv("DM_WORKERS", "8"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "1"))
+# 大きなサーバーでは MEMBER_CACHE=joined と CHUNK_GUILDS_AT_STARTUP=0 でメモリと起動時間を抑えられる
+# （benchmark/member_cache.py）。その場合、
+# - 起動時と AVATAR_RECONCILE_INTERVAL ごとにメンバー一覧APIを1回走査する（1000人ごとに1リクエスト、ギルドごと）。
+#   初期アイコンロールと招待者ロールを持つメンバーはキャッシュに入れる（起動時は100人ごとにゲートウェイで1回照会）ので、
+#   そのアイコン変更・ロール変更・表示名変更はすぐに反映される
+# - ボットの外で初期アイコンロールや招待者ロールを付けられたメンバーは、次の走査まで反映されない（最大 AVATAR_RECONCILE_INTERVAL 秒）
+# - それ以外のメンバーは必要になった時点でAPIから取得する
+MEMBER_CACHE = os.getenv("MEMBER_CACHE", "all")  # all / joined
+CHUNK_GUILDS_AT_STARTUP = os.getenv("CHUNK_GUILDS_AT_STARTUP", "1") == "1"
+# ロールIDを設定しておくとロール名が変更されても追従する（例: ROLE_ID_EXPLAINING）
+ROLE_IDS = {
+    key: int(os.environ[f"ROLE_ID_{key.upper()}"])
+    for key in FUNNEL_ROLE_NAMES
+    if os.getenv(f"ROLE_ID_{key.upper()}")
+}
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+db = Database(supabase, max_workers=SUPABASE_MAX_WORKERS, timeout=SUPABASE_TIMEOUT, slow_threshold=SUPABASE_SLOW_MS / 1000)
 
 intents = discord.Intents.default()
 intents.members = True
 intents.dm_messages = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
-
-DEFAULT_TIMEOUT = 3600
+# シャード数は Discord の推奨値に従う（複数のサーバーを1つのデプロイで扱う）
+bot = commands.AutoShardedBot(
+    command_prefix="!", intents=intents, http_trace=discord_trace_config(),
+    member_cache_flags=member_cache_flags(MEMBER_CACHE, intents), chunk_guilds_at_startup=CHUNK_GUILDS_AT_STARTUP,
+)
+guild_configs = GuildConfigStore(db, GuildConfig(
+    None, FUNNEL_ROLE_NAMES, ROLE_IDS, INVITER_GUILD_ID, INVITER_ROLE_ID, INVITE_URL, ADMIN_USER_ID, ADMIN_CHANNEL_ID,
+))
+role_index = RoleIndex(guild_configs)
+inviter_rosters = InviterRosters(bot, guild_configs)
+pending_avatars = PendingAvatars()
+avatar_reconciler = None
+loop_lag_monitor = None
+dm_outbox = DMOutbox(bot, rate=DM_RATE, workers=DM_WORKERS)
+invite_caches = InviteMessageCaches(bot, dm_outbox, guild_configs, ttl=INVITE_CACHE_TTL)
+session_store = SessionStore(db)
+dm_router = DMReplyRouter()
+answer_buffer = AnswerBuffer(db, ANSWER_JOURNAL_PATH, batch_size=ANSWER_BATCH_SIZE, flush_interval=ANSWER_FLUSH_INTERVAL)
 
 HEADERS = {
     "apikey": SUPABASE_KEY,
@@ -44,377 +117,215 @@ def is_initial_avatar(member: discord.Member) -> bool:
 
 @bot.event
 async def on_ready():
-    print(f"Logged in as {bot.user}")
+    for guild in bot.guilds:
+        role_index.build(guild)
+    invite_caches.start(guild.id for guild in bot.guilds)
+    questionnaire.start_sweeper()
+    # 招待者一覧もここで作る。再接続時も on_ready が呼ばれるので、切断中のアイコン変更もここで拾う
+    await reconcile_pending_avatars()
+    global avatar_reconciler
+    if avatar_reconciler is None or avatar_reconciler.done():
+        avatar_reconciler = asyncio.create_task(avatar_reconcile_loop())
+    log.info("Logged in as %s", bot.user)
+
+# 永続ビューを登録し、保存済みの質問セッションを読み込む（再起動後もボタンから再開できる）
+@bot.event
+async def setup_hook():
+    bot.add_view(ParticipateView())
+    bot.add_dynamic_items(*DYNAMIC_ITEMS)
+    dm_outbox.start()
+    try:
+        count = await guild_configs.load()
+        log.info("✅ ギルド設定を %s 件読み込みました", count)
+    except Exception as e:
+        log.exception("❌ ギルド設定の読み込みに失敗しました（既定の設定で動作します）: %s", e)
+    replayed = answer_buffer.replay()
+    if replayed:
+        log.info("♻️ 未送信の回答 %s 件をジャーナルから再送します", replayed)
+    answer_buffer.start()
+    try:
+        count = await questionnaire.restore()
+        log.info("✅ 進行中の質問セッションを %s 件読み込みました", count)
+    except Exception as e:
+        log.exception("❌ 質問セッションの読み込みに失敗しました: %s", e)
+    start_metrics()
+
+
+def start_metrics():
+    REGISTRY.gauge_fn("gateway_latency_seconds", lambda: bot.latency)
+    REGISTRY.gauge_fn("gateway_connected", lambda: int(bot.is_ready() and bool(bot.shards) and not any(s.is_closed() for s in bot.shards.values())))
+    REGISTRY.gauge_fn("gateway_shards", lambda: len(bot.shards))
+    REGISTRY.gauge_fn("guilds", lambda: len(bot.guilds))
+    REGISTRY.gauge_fn("questionnaire_active_sessions", lambda: questionnaire.active_count)
+    REGISTRY.gauge_fn("questionnaire_waiting", lambda: len(questionnaire.waiting))
+    REGISTRY.gauge_fn("dm_outbox_queued", lambda: len(dm_outbox))
+    REGISTRY.gauge_fn("answer_buffer_pending", lambda: len(answer_buffer.pending))
+    REGISTRY.gauge_fn("pending_avatar_members", lambda: len(pending_avatars))
+    global loop_lag_monitor
+    if loop_lag_monitor is None or loop_lag_monitor.done():
+        loop_lag_monitor = asyncio.create_task(monitor_loop_lag(REGISTRY, LOOP_LAG_INTERVAL))
+
+# 質問への回答待ちのユーザーからのDMはルーターに渡し、それ以外はコマンドとして扱う
+@bot.event
+async def on_message(message: discord.Message):
+    if message.author.bot:
+        return
+    if isinstance(message.channel, discord.DMChannel) and await dm_router.dispatch(message):
+        return
+    await bot.process_commands(message)
 
+# 招待メッセージの編集・招待の削除でキャッシュを破棄して再取得する
 @bot.event
-async def on_member_join(member: discord.Member):
-    if is_initial_avatar(member):
-        role = discord.utils.get(member.guild.roles, name="初期アイコン")
-    else:
-        role = discord.utils.get(member.guild.roles, name="説明中")
-    if role:
-        await member.add_roles(role)
-    if role and role.name == "初期アイコン":
-        # 初期アイコンロール付与時にアイコン変更を促すDMを送信
-        try:
-            dm = await member.create_dm()
-            await dm.send("初期アイコンの状態です。プロフィール画像を変更してください。変更後、再度参加手続きを進められます。")
-        except Exception as e:
-            print(f"DM送信失敗: {e}")
-    if role and role.name == "説明中":
-        await start_questionnaire(member)
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    invite_caches.on_message_edit(payload.message_id)
 
 @bot.event
-async def on_user_update(before: discord.User, after: discord.User):
-    if before.avatar != after.avatar:
-        for guild in bot.guilds:
-            member = guild.get_member(after.id)
-            if member:
-                has_initial = discord.utils.get(guild.roles, name="初期アイコン")
-                if has_initial and has_initial in member.roles:
-                    await member.remove_roles(has_initial)
-                    if is_initial_avatar(member):
-                        await member.add_roles(has_initial)
-                    else:
-                        role2 = discord.utils.get(guild.roles, name="説明中")
-                        if role2:
-                            await member.add_roles(role2)
-                            await start_questionnaire(member)
+async def on_invite_delete(invite: discord.Invite):
+    invite_caches.on_invite_delete(invite.code)
 
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    role_index.build(guild)
+    await inviter_rosters.rebuild(guild)
 
-async def update_user_role(member: discord.Member):
-    guild = member.guild  # メンバーが所属するギルド（サーバー）
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    role_index.forget(guild)
 
-    # ロール名で指定（大文字・小文字・全角・半角も正確に！）
-    EXPLAINING_ROLE_NAME = "説明中"
-    INVITED_ROLE_NAME = "招待済み"
+# ロールの作成・変更・削除時はそのギルドの索引だけ作り直す
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    role_index.build(role.guild)
 
-    explaining_role = get(guild.roles, name=EXPLAINING_ROLE_NAME)
-    invited_role = get(guild.roles, name=INVITED_ROLE_NAME)
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    role_index.build(after.guild)
 
-    if explaining_role is None or invited_role is None:
-        print("⚠️ ロールが見つかりません。名前が正しいか確認してください。")
-        return
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    role_index.build(role.guild)
 
-    try:
-        if explaining_role in member.roles:
-            await member.remove_roles(explaining_role)
-            print(f"❌ {EXPLAINING_ROLE_NAME} ロールを削除: {member.display_name}")
+# 招待者ロールの付け外しや表示名の変更を招待者一覧に反映する
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    inviter_rosters.update(after)
+    initial_role = role_index.get(after.guild, "initial")
+    if initial_role:
+        pending_avatars.mark(after, after.get_role(initial_role.id) is not None)
 
-        await member.add_roles(invited_role)
-        print(f"✅ {INVITED_ROLE_NAME} ロールを付与: {member.display_name}")
+# キャッシュにいないメンバーの退出も拾えるよう raw イベントを使う
+@bot.event
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    inviter_rosters.remove(payload.guild_id, payload.user.id)
+    pending_avatars.discard(payload.user.id, payload.guild_id)
 
-    except discord.Forbidden:
-        print("⚠️ ロール変更に必要な権限がありません。")
-    except discord.HTTPException as e:
-        print(f"⚠️ Discord APIエラー: {e}")
+@bot.event
+async def on_member_join(member: discord.Member):
+    initial_avatar = is_initial_avatar(member)
+    await role_index.apply(member, "initial" if initial_avatar else "explaining", reason="参加時のロール付与")
+    pending_avatars.mark(member, initial_avatar)
+    if initial_avatar:
+        # 初期アイコンロール付与時にアイコン変更を促すDMを送信
+        dm_outbox.send(member, "初期アイコンの状態です。プロフィール画像を変更してください。変更後、再度参加手続きを進められます。")
+    else:
+        await start_questionnaire(member)
 
-async def send_invite_message(dm_channel, invite_url):
-    match = re.search(r'discord\.com/channels/(\d+)/(\d+)/(\d+)', invite_url)
-    if not match:
-        await dm_channel.send("招待リンクが無効です。")
+@bot.event
+async def on_user_update(before: discord.User, after: discord.User):
+    # 初期アイコンロールを持つユーザー以外は何もしない
+    if before.avatar == after.avatar or not pending_avatars.guilds_for(after.id):
         return
-
-    guild_id, channel_id, message_id = map(int, match.groups())
-
-    try:
-        # メッセージ取得
-        channel = await bot.fetch_channel(channel_id)
-        message = await channel.fetch_message(message_id)
-
-        # 招待リンクを抽出
-        invite_match = re.search(r'(https?://)?(www\.)?(discord\.gg|discord\.com/invite)/[a-zA-Z0-9]+', message.content)
-        if invite_match:
-            invite_url = invite_match.group(0)
-
+    for guild_id in list(pending_avatars.guilds_for(after.id)):
+        guild = bot.get_guild(guild_id)
+        member = await get_or_fetch_member(guild, after.id) if guild else None
+        if member:
+            await release_initial_avatar(member)
+
+# アイコンを設定したメンバーを初期アイコンから説明中に進める
+async def release_initial_avatar(member: discord.Member):
+    if is_initial_avatar(member):
+        return
+    pending_avatars.discard(member.id, member.guild.id)
+    await role_index.apply(member, "explaining", reason="アイコン変更")
+    await start_questionnaire(member)
+
+# 初期アイコンロールと招待者ロールを持つメンバーを集めて、アイコン変更待ちの集合と招待者一覧を作り直し、
+# 取りこぼしたアイコン変更を処理する。チャンクしていないギルドではメンバー一覧APIを1回だけ走査し
+# （取得したメンバーはアイコンも最新）、見つかったメンバーをキャッシュに入れて以後のイベントが届くようにする
+async def reconcile_pending_avatars():
+    guild_ids = [guild.id for guild in bot.guilds]
+    for guild in bot.guilds:
+        initial_role = role_index.get(guild, "initial")
+        role_ids = {role_id for _, role_id in inviter_rosters.keys_for(guild, guild_ids)}
+        if initial_role:
+            role_ids.add(initial_role.id)
+        try:
+            members_by_role = await members_with_roles(guild, role_ids)
+        except Exception as e:
+            log.warning("⚠️ メンバーの取得に失敗しました（%s）: %s", guild.name, e, extra={"guild_id": guild.id})
+            continue
+        inviter_rosters.fill(guild, guild_ids, members_by_role)
+        members = members_by_role.get(initial_role.id, []) if initial_role else []
+        pending_avatars.rebuild(guild, members)
+        try:
+            await cache_members(guild, [m for tracked in members_by_role.values() for m in tracked])
+        except Exception as e:
+            log.warning("⚠️ メンバーをキャッシュに入れられませんでした（%s）: %s", guild.name, e, extra={"guild_id": guild.id})
+        for member in members:
             try:
-                # 招待の有効性を確認
-                invite = await bot.fetch_invite(invite_url)
-                # 有効：そのまま送信
-                await dm_channel.send(message.content)
-
-            except discord.NotFound:
-                # 無効：案内を送って管理者に通知
-                await dm_channel.send("""この招待リンクは現在無効です。
-管理者から新しいリンクが送付されるまでしばらくお待ちください。""")
-
-                # # 管理者にDMで通知
-                admin_user = await bot.fetch_user(ADMIN_USER_ID)
-                user = dm_channel.recipient  # DMの相手（案内を受けたユーザー）
-
-                await admin_user.send(
-                    f"⚠️ 無効な招待リンクが使用されました。\n"
-                    f"・元メッセージリンク: https://discord.com/channels/{guild_id}/{channel_id}/{message_id}\n"
-                    f"・対象ユーザー: {user} (`{user.id}`)"
-                )
+                await release_initial_avatar(member)
+            except Exception as e:
+                log.warning("⚠️ 初期アイコンの再確認に失敗しました（%s）: %s", member, e, extra={"member_id": member.id})
 
-        else:
-            await dm_channel.send("メッセージに招待リンクが含まれていません。")
+async def avatar_reconcile_loop():
+    while True:
+        await asyncio.sleep(AVATAR_RECONCILE_INTERVAL)
+        try:
+            await reconcile_pending_avatars()
+        except Exception as e:
+            log.exception("⚠️ 初期アイコンの定期確認に失敗しました: %s", e)
 
-    except discord.NotFound:
-        await dm_channel.send("指定されたメッセージが見つかりませんでした。")
-    except discord.Forbidden:
-        await dm_channel.send("メッセージにアクセスする権限がありません。")
-    except Exception as e:
-        await dm_channel.send(f"メッセージ取得中にエラーが発生しました：{e}")
-
-# --- 招待者選択用Select ---
-class InviterSelect(ui.Select):
-    def __init__(self, inviter_mapping: dict[str, str]):
-        options = [
-            discord.SelectOption(label=name, value=inviter_id)
-            for inviter_id, name in inviter_mapping.items()
-        ]
-        super().__init__(placeholder="招待者を選択してください", options=options, max_values=1, min_values=1)
-        self.selected_id = None
 
-    async def callback(self, interaction: discord.Interaction):
-        self.selected_id = self.values[0]
-        await interaction.response.send_message(f"{self.view.inviter_mapping[self.selected_id]} を選択しました。", ephemeral=True)
-        self.view.selected_id = self.selected_id
-        self.view.stop()
-
-class InviterSelectView(ui.View):
-    def __init__(self, member: discord.Member, inviter_mapping: dict[str, str]):
-        super().__init__(timeout=DEFAULT_TIMEOUT)
-        self.member = member
-        self.inviter_mapping = inviter_mapping
-        self.selected_id = None
-        self.add_item(InviterSelect(inviter_mapping))
-
-    async def interaction_check(self, interaction: discord.Interaction) -> bool:
-        return interaction.user.id == self.member.id
-
-    @ui.button(label="キャンセル", style=discord.ButtonStyle.danger)
-    async def cancel_button(self, interaction: discord.Interaction, button: ui.Button):
-        await interaction.response.send_message("キャンセルされました。", ephemeral=True)
-        self.stop()
-
-# --- Yes/No ボタンView ---
-class YesNoView(ui.View):
-    def __init__(self, member: discord.Member, question_key: str, timeout=DEFAULT_TIMEOUT):
-        super().__init__(timeout=timeout)
-        self.member = member
-        self.question_key = question_key
-        self.answer = None
-
-    async def interaction_check(self, interaction: discord.Interaction) -> bool:
-        return interaction.user.id == self.member.id
-
-    @ui.button(label="YES", style=discord.ButtonStyle.success)
-    async def yes_button(self, interaction: discord.Interaction, button: ui.Button):
-        self.answer = "yes"
-        await interaction.response.send_message("はい を選択しました。", ephemeral=True)
-        self.stop()
-
-    @ui.button(label="NO", style=discord.ButtonStyle.danger)
-    async def no_button(self, interaction: discord.Interaction, button: ui.Button):
-        self.answer = "no"
-        await interaction.response.send_message("いいえ を選択しました。", ephemeral=True)
-        self.stop()
-
-async def start_questionnaire(member: discord.Member):
-    dm = await member.create_dm()
-    answers = {}
-
-    guild = bot.get_guild(1361763625953398945)  # ここに対象のサーバーIDを入れる
-    role = guild.get_role(1373499098359136256)  # 対象のロールID
-
-    inviter_mapping = {}
-
-    for inviter_member in role.members:
-        inviter_mapping[str(inviter_member.id)] = inviter_member.display_name
-
-    # 招待者選択ビューに渡す
-    view = InviterSelectView(member, inviter_mapping)
-    await dm.send("招待者を選択してください。", view=view)
-    await view.wait()
-    if view.selected_id is None:
-        await dm.send("招待者選択がキャンセルされたか、時間切れです。")
+async def update_user_role(member: discord.Member):
+    if role_index.get(member.guild, "invited") is None:
+        log.warning("⚠️ ロールが見つかりません。名前またはROLE_ID_*の設定を確認してください。")
         return
-    answers["招待者"] = view.selected_id
-
-    # 生年月日質問（テキスト入力方式に変更）
-    await dm.send("生年月日を「YYYY-MM-DD」の形式で入力してください。")
-
-    def check(m):
-        return m.author == member and isinstance(m.channel, discord.DMChannel)
 
     try:
-        msg = await bot.wait_for("message", timeout=120, check=check)
-        dob_str = msg.content.strip()
-        dob = datetime.strptime(dob_str, "%Y-%m-%d")
-    except asyncio.TimeoutError:
-        await dm.send("時間切れです。生年月日が入力されませんでした。中断します。")
-        return
-    except ValueError:
-        await dm.send("入力形式が正しくありません。`YYYY-MM-DD` の形式で入力してください。中断します。")
-        return
-
-    answers["生年月日"] = dob_str
-
-    # 学年判定
-    def is_high_school_student(dob: datetime) -> bool:
-        today = datetime.today()
-        school_year_start = datetime(today.year, 4, 1)
-        base_year = today.year if today >= school_year_start else today.year - 1
-        age_on_april_1 = base_year - dob.year - ((dob.month, dob.day) > (4, 1))
-        return age_on_april_1 <= 17
-
-    if is_high_school_student(dob):
-        role = discord.utils.get(member.guild.roles, name="資格無し")
-        if role:
-            await member.add_roles(role)
-        await dm.send("""現在高校生相当のため、参加資格がありません。
-    誤答の場合はあるかなまでご連絡ください。""")
-        await store_answers(member.id, answers)
-        return
-
-
-    # 「現在高校生ですか？」質問
-    view = YesNoView(member, "高校卒業確認")
-    await dm.send("あなたは現在高校生ですか？", view=view)
-    await view.wait()
-    if view.answer is None:
-        await dm.send("時間切れです。")
-        return
-    answers["高校卒業確認"] = view.answer
-
-    if view.answer == "yes":
-        role = discord.utils.get(member.guild.roles, name="資格無し")
-        if role:
-            await member.add_roles(role)
-        await dm.send("""現在高校生のため、参加資格がありません。
-誤答の場合はあるかなまでご連絡ください。""")
-        await store_answers(member.id, answers)
-        return
+        await role_index.apply(member, "invited", reason="質問完了")
+        log.info("✅ 招待済みロールを付与: %s", member.display_name, extra={"member_id": member.id})
+    except discord.Forbidden:
+        log.warning("⚠️ ロール変更に必要な権限がありません。", extra={"member_id": member.id})
+    except discord.HTTPException as e:
+        log.warning("⚠️ Discord APIエラー: %s", e, extra={"member_id": member.id})
 
-    # 「過去Lawlessに参加していた？」質問
-    view = YesNoView(member, "出戻り確認")
-    await dm.send("過去Lawlessというサーバーに参加していたことがありましたか？", view=view)
-    await view.wait()
-    if view.answer is None:
-        await dm.send("時間切れです。")
-        return
-    answers["出戻り確認"] = view.answer
-
-    if view.answer == "yes":
-        role = discord.utils.get(member.guild.roles, name="出戻り")
-        if role:
-            await member.add_roles(role)
-        await dm.send("""出戻りの方は原則参加禁止となっています。
-誤答、または出戻りでも参加したい場合はあるかなまでご連絡ください。""")
-        await store_answers(member.id, answers)
-        return  # ✅ 中断
-
-
-    # 「以上、確認できましたか？（サーバー説明）」質問
-    view = YesNoView(member, "サーバー説明")
-    await dm.send("""これから招待させていただく**__Lawless__**というサーバーはエロイプを中心としたサーバーです。
-                  
-サーバーの方針として**__声の善し悪し__**が重視される傾向にあり、
-声が良ければそれだけ優遇されます。
-                  
-もちろん声に自信がなくても蹴られる！ということはなく、
-トーク力や浮上率などその他の要素も考慮されますが、声が第1の評価基準になります。
-確認できましたか？""", view=view)
-    await view.wait()
-    if view.answer is None:
-        await dm.send("時間切れです。")
-        return
-    answers["サーバー説明"] = view.answer
-
-    if view.answer != "yes":
-        role = discord.utils.get(member.guild.roles, name="資格無し")
-        if role:
-            await member.add_roles(role)
-        await dm.send("""サーバーについてご理解いただけない方は、参加資格がありません。
-誤答の場合はあるかなまでご連絡ください。""")
-        await store_answers(member.id, answers)
-        return
+async def send_invite_message(guild_id: int, user_id: int, dm_channel):
+    await invite_caches.for_guild(guild_id).send(dm_channel, user_id)
 
-    # 「以上、確認できましたか？（ルール確認）」質問
-    view = YesNoView(member, "ルール確認")
-    await dm.send("""Lawlessでは鯖主である**__やまげさんが絶対のルール__**です。
-                  
-一つ一つ細かくルールを記載するととても長くなり穴も生まれるため
-運営上効率がいい鯖主を絶対のルールとする形をとっています。
-                  
-もちろん理不尽に怒られる・蹴られるなどは無いため、そこは心配しなくても大丈夫です。
-                  
-とはいえ、全くルールがない状態だと基準が分からず困るため
-大まかなルールについてはサーバーに記載があります。
-しっかりと読み込んでください。
-以上、確認できましたか？""", view=view)
-    await view.wait()
-    if view.answer is None:
-        await dm.send("時間切れです。")
-        return
-    answers["ルール確認"] = view.answer
-
-    if view.answer != "yes":
-        role = discord.utils.get(member.guild.roles, name="資格無し")
-        if role:
-            await member.add_roles(role)
-        await dm.send("""ルールを理解していない方は、参加資格がありません。
-誤答の場合はあるかなまでご連絡ください。""")
-        await store_answers(member.id, answers)
-        return
+async def start_questionnaire(member: discord.Member, restart: bool = False) -> str:
+    return await questionnaire.start(member, restart=restart)
 
-    # 「以上を実行していただけますか？」質問
-    view = YesNoView(member, "面接の予約")
-    await dm.send("""## サーバーに参加した際にして欲しいこと
-最後に、入ってからしてもらいたいことがいくつかあります。
-                  
-1つ目が最初の**__案内を読み飛ばさず、該当の項目にチェックを入れること__**です。
-性別などのチェック欄が出てくるので、一つ一つしっかりとチェックしてください。
-                  
-2つ目が**__ルールの確認__**です。
-サーバーに参加するとルール確認というチャンネルが見えるかと思います。
-中身を確認・理解し、遵守してください。
-                  
-3つ目が**__面接の予約__**です。
-当サーバーでは日本語が話せるかの確認程度の簡単な面接を行っています。
-面接は水曜日を除いた22時、その他土日、水曜日を除き不定期で13,25時に行っています。
-この中で都合のいい時間帯を選び、22時の場合は面接日程に、13,25時の場合はサブ面接日程に
-『"""+str(inviter_mapping[answers["招待者"]])+"""からの招待で来ました。️
-〇月️〇日の〇時から面接をお願いします』
-と書き込みをお願いします。 また、日程は面接官の都合により変更される可能性があります。
-面接日程チャンネルで面接前にお知らせが入るのでそこを参照して予約をお願いします。
-
-以上を実行していただけますか？""", view=view)
-    await view.wait()
-    if view.answer is None:
-        await dm.send("時間切れです。")
-        return
-    answers["面接の予約"] = view.answer
-
-    if view.answer != "yes":
-        role = discord.utils.get(member.guild.roles, name="資格無し")
-        if role:
-            await member.add_roles(role)
-        await dm.send("""面接の予約を実行できない方には、参加資格がありません。
-誤答の場合はあるかなまでご連絡ください。""")
-        await store_answers(member.id, answers)
-        return
+# 全質問回答後
+async def complete_questionnaire(user_id: int, guild_id: int, member: discord.Member | None, dm: discord.DMChannel, answers: dict):
+    await send_invite_message(guild_id, user_id, dm)
+    await store_answers(user_id, guild_id, answers)
+    if member:
+        await update_user_role(member)
 
-    # 全質問回答後
-    await send_invite_message(dm, INVITE_URL)
-    await store_answers(member.id, answers)
-    await update_user_role(member)
+# 回答はバッファに積み、AnswerBuffer がまとめてupsertする（ギルドごとに1行）
+async def store_answers(user_id: int, guild_id: int, answers: dict):
+    answer_buffer.add({"id": str(user_id), "guild_id": str(guild_id), **answers})
 
-async def store_answers(user_id: int, answers: dict):
-    data = {"id": str(user_id), **answers}
-    try:
-        resp = supabase.table("responses").upsert(data).execute()
-        print("✅ 回答をSupabaseに保存しました:", resp.data)
-    except Exception as e:
-        print(f"❌ Supabase保存エラー: {e}")
+questionnaire = Questionnaire(
+    bot, QuestionnaireDefinition.load(QUESTIONNAIRE_PATH), session_store, dm_router, dm_outbox, role_index, inviter_rosters, store_answers, complete_questionnaire,
+    max_active=MAX_ACTIVE_SESSIONS,
+)
+bot.questionnaire = questionnaire  # 永続ビューのコールバックから参照する
 
 # 参加ボタン付きメッセージを指定チャンネルに送信する関数
 class ParticipateButton(ui.Button):
     def __init__(self):
-        super().__init__(label="参加する", style=discord.ButtonStyle.primary)
+        super().__init__(label="参加する", style=discord.ButtonStyle.primary, custom_id="participate")
 
     async def callback(self, interaction: discord.Interaction):
         member = interaction.user
@@ -423,17 +334,22 @@ class ParticipateButton(ui.Button):
             await interaction.response.send_message("このコマンドはサーバー内で実行してください。", ephemeral=True)
             return
 
-        role_initial = get(guild.roles, name="初期アイコン")
-        role_explaining = get(guild.roles, name="説明中")
-        role_returnee = get(guild.roles, name="出戻り")
-        role_invited = get(guild.roles, name="招待済み")
+        role_initial = role_index.get(guild, "initial")
+        role_explaining = role_index.get(guild, "explaining")
+        role_returnee = role_index.get(guild, "returnee")
+        role_invited = role_index.get(guild, "invited")
 
         user_roles = member.roles
 
         if role_explaining and role_explaining in user_roles:
             await interaction.response.defer(ephemeral=True)
-            await start_questionnaire(member)
-            await interaction.followup.send("質問を開始しました。DMを確認してください。", ephemeral=True)
+            status = await start_questionnaire(member)
+            if status == "running":
+                await interaction.followup.send("すでに質問が進行中です。DMを確認してください。", ephemeral=True)
+            elif status == "queued":
+                await interaction.followup.send("現在混み合っています。順番が来たらDMで質問が始まります。", ephemeral=True)
+            else:
+                await interaction.followup.send("質問を開始しました。DMを確認してください。", ephemeral=True)
         elif role_initial and role_initial in user_roles:
             await interaction.response.send_message("プロフィール画像を変更してください。", ephemeral=True)
         elif role_returnee and role_returnee in user_roles:
@@ -453,7 +369,7 @@ class ParticipateView(ui.View):
 async def send_participate_message(ctx,channel_id: int, text: str):
     channel = bot.get_channel(channel_id)
     if channel is None:
-        print(f"チャンネルID {channel_id} が見つかりません。")
+        log.warning("チャンネルID %s が見つかりません。", channel_id)
         return
     await channel.send(text, view=ParticipateView())
     await ctx.send("参加ボタン付きメッセージを送信しました。")
@@ -463,221 +379,359 @@ async def send_participate_message(ctx,channel_id: int, text: str):
 async def start_questionnaire_manual(ctx, member: discord.Member):
     try:
         await ctx.send(f"{member.display_name} に質問を開始します。")
-        await start_questionnaire(member)
+        status = await start_questionnaire(member, restart=True)
+        if status == "queued":
+            await ctx.send("同時進行数の上限に達しているため、順番待ちに追加しました。")
     except Exception as e:
         await ctx.send(f"❌ エラー: {e}")
 
+# 質問定義（questionnaire.json）を再読み込みする。再起動せずに文言や分岐を変更できる
+@bot.command(name="reload_questionnaire")
+@commands.has_permissions(administrator=True)
+async def reload_questionnaire(ctx):
+    try:
+        definition = QuestionnaireDefinition.load(QUESTIONNAIRE_PATH)
+        questionnaire.reload(definition)
+        await ctx.send(f"✅ 質問定義を再読み込みしました（{len(definition.steps)} ステップ）。")
+    except Exception as e:
+        await ctx.send(f"❌ 再読み込みに失敗しました: {e}")
+
+# ギルド設定の変更をキャッシュに反映する（ロールの索引・招待者一覧・招待メッセージを作り直す）
+def apply_guild_configs():
+    inviter_rosters.reset()
+    invite_caches.reset()
+    for guild in bot.guilds:
+        role_index.build(guild)
+        inviter_rosters.for_guild(guild.id)
+    invite_caches.start(guild.id for guild in bot.guilds)
+
+@bot.command(name="guild_config")
+@commands.has_permissions(manage_guild=True)
+async def show_guild_config(ctx):
+    config = guild_configs.get(ctx.guild.id)
+    await ctx.send("⚙️ このサーバーの設定\n" + "\n".join(f"- {line}" for line in config.describe()))
 
-json_string = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
-if not json_string:
-    raise RuntimeError("環境変数 GOOGLE_SERVICE_ACCOUNT_JSON が設定されていません")
+# 例: !set_guild_config inviter_role 1373499098359136256 / !set_guild_config role.explaining 123 / 値を省略すると既定値に戻す
+@bot.command(name="set_guild_config")
+@commands.has_permissions(administrator=True)
+async def set_guild_config(ctx, key: str, value: str = ""):
+    try:
+        await guild_configs.set(ctx.guild.id, key, value)
+        apply_guild_configs()
+        await ctx.send(f"✅ {key} を更新しました。")
+    except Exception as e:
+        await ctx.send(f"❌ 更新に失敗しました: {e}")
 
-# 一時ファイルに保存して認証
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-with tempfile.NamedTemporaryFile(mode="w+", suffix=".json", delete=False) as tmp_file:
-    tmp_file.write(json_string)
-    tmp_file.flush()
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(tmp_file.name, scope)
-    gc = gspread.authorize(credentials)
+# Supabaseで guild_configs を直接編集したあとに読み込み直す
+@bot.command(name="reload_guild_config")
+@commands.has_permissions(administrator=True)
+async def reload_guild_config(ctx):
+    try:
+        count = await guild_configs.load()
+        apply_guild_configs()
+        await ctx.send(f"✅ ギルド設定を再読み込みしました（{count} 件）。")
+    except Exception as e:
+        await ctx.send(f"❌ 再読み込みに失敗しました: {e}")
+
+# 指定ロールを持つメンバー全員にファネルの状態（initial / explaining / invited / returnee / ineligible）を適用する。
+# Discordのレート制限に引っかからないよう、ワーカー数と1秒あたりの件数を絞って処理する
+@bot.command(name="reapply_roles")
+@commands.has_permissions(manage_roles=True)
+async def reapply_roles(ctx, role: discord.Role, state: str):
+    if state not in FUNNEL_STATES:
+        await ctx.send(f"❌ 状態は {' / '.join(FUNNEL_STATES)} のいずれかを指定してください。")
+        return
+    members = await members_with_role(ctx.guild, role.id)
+    await ctx.send(f"🔧 {len(members)} 人に {state} を適用します（目安: 約{round(len(members) / ROLE_EDIT_RATE)}秒）...")
+
+    async def apply(member: discord.Member, pacer: Pacer) -> bool:
+        if {r.id for r in role_index.target_roles(member, state)} == {r.id for r in member.roles if not r.is_default()}:
+            return False
+        await pacer.wait()
+        return await role_index.apply(member, state, reason=f"{ctx.author} による一括適用")
+
+    done, skipped, failed = await run_throttled(members, apply, ROLE_EDIT_WORKERS, Pacer(ROLE_EDIT_RATE))
+    result_message = (
+        f"✅ ロールの一括適用が完了しました\n"
+        f"- 変更: {done} 件\n"
+        f"- 変更なし: {skipped} 件\n"
+        f"- 失敗: {len(failed)} 件"
+    )
+    if failed:
+        result_message += "\n" + "\n".join(f"❌ {m.display_name}: {e}" for m, e in failed[:10])
+    await ctx.send(result_message)
+
+# 質問セッションの負荷状況を確認する
+@bot.command(name="questionnaire_status")
+@commands.has_permissions(manage_guild=True)
+async def questionnaire_status(ctx):
+    limit = questionnaire.max_active or "無制限"
+    await ctx.send(
+        f"📋 質問セッション\n"
+        f"- 進行中: {questionnaire.active_count} 件\n"
+        f"- 順番待ち: {len(questionnaire.waiting)} 件\n"
+        f"- 上限: {limit}"
+    )
+
+
+# スプレッドシートには初回の出力時に接続する
+sheets = SheetsClient(os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON"), "invites")
+
+INVITE_COLUMNS = ["inviter_id", "invited_id", "gender", "invite_method"]
+
+def chunked(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# 添付ファイル（CSV/TSV）を行ごとのセル配列に変換する
+async def read_invite_attachment(attachment: discord.Attachment) -> list[list[str]]:
+    text = (await attachment.read()).decode("utf-8-sig")
+    delimiter = "\t" if attachment.filename.lower().endswith(".tsv") else ","
+    rows = [row for row in csv.reader(io.StringIO(text), delimiter=delimiter) if any(cell.strip() for cell in row)]
+    # ヘッダー行があればスキップ
+    if rows and [cell.strip() for cell in rows[0]] == INVITE_COLUMNS:
+        rows = rows[1:]
+    return rows
+
+# 全行を先に検証し、登録用データとフォーマットエラーに振り分ける
+def parse_invite_rows(rows: list[list[str]]) -> tuple[list[dict], list[str]]:
+    records = []
+    failed_lines = []
+    for row in rows:
+        parts = [cell.strip() for cell in row]
+        if len(parts) != 4 or not all(parts):
+            failed_lines.append(f"❌ フォーマットエラー: `{' '.join(row)}`")
+            continue
+
+        inviter_id, invited_id, gender, method = parts
+        records.append({
+            "inviter_id": inviter_id,
+            "invited_id": invited_id,
+            "invite_method": method,
+            "gender": gender
+        })
+    return records, failed_lines
+
+# チャンク単位でまとめてinsertし、Supabaseが拒否したチャンクのみ1行ずつ再試行する。
+# タイムアウトや接続エラーはスレッド側で書き込みが完了している可能性があるため再試行せず、
+# 結果不明として invited_id を返す（再試行すると二重登録になりうる）
+async def insert_invites(records: list[dict]) -> tuple[int, list[str], list[str]]:
+    success_count = 0
+    failed_lines = []
+    unknown_ids = []
+    for chunk in chunked(records, INVITE_BULK_CHUNK_SIZE):
+        try:
+            await db.execute("add_invite_bulk", lambda c: c.table("invites").insert(chunk))
+            success_count += len(chunk)
+            continue
+        except APIError as e:
+            log.warning("⚠️ 一括登録に失敗したため1行ずつ再試行します: %s", e, extra={"rows": len(chunk)})
+        except Exception as e:
+            log.warning("⚠️ 一括登録の結果が不明です: %s", e, extra={"rows": len(chunk)})
+            unknown_ids.extend(data["invited_id"] for data in chunk)
+            continue
 
-# スプレッドシートに接続
-spreadsheet = gc.open("invites")
-worksheet = spreadsheet.sheet1
+        for data in chunk:
+            try:
+                await db.execute("add_invite_bulk_row", lambda c: c.table("invites").insert(data))
+                success_count += 1
+            except APIError as e:
+                failed_lines.append(f"❌ エラー（{data['invited_id']}）: {str(e)}")
+            except Exception as e:
+                log.warning("⚠️ 登録の結果が不明です（%s）: %s", data["invited_id"], e)
+                unknown_ids.append(data["invited_id"])
+    return success_count, failed_lines, unknown_ids
 
-# ✅ 通常コマンド：招待情報を手動で登録
+# ✅ 通常コマンド：招待情報を手動で登録（本文 or CSV/TSV添付）
 @bot.command(name="add_invite_bulk")
 @commands.has_permissions(manage_guild=True)
 async def add_invite_bulk(ctx):
     try:
         content = ctx.message.content
-        lines = content.splitlines()[1:]  # 1行目はコマンド名なのでスキップ
-        success_count = 0
-        fail_count = 0
-        failed_lines = []
-
-        for line in lines:
-            parts = line.strip().split()
-            if len(parts) != 4:
-                fail_count += 1
-                failed_lines.append(f"❌ フォーマットエラー: `{line}`")
-                continue
-
-            inviter_id, invited_id, gender, method = parts
-            data = {
-                "inviter_id": inviter_id,
-                "invited_id": invited_id,
-                "invite_method": method,
-                "gender": gender
-            }
+        rows = [line.strip().split() for line in content.splitlines()[1:]]  # 1行目はコマンド名なのでスキップ
+        rows = [row for row in rows if row]
+        for attachment in ctx.message.attachments:
+            rows.extend(await read_invite_attachment(attachment))
 
-            try:
-                supabase.table("invites").insert(data).execute()
-                success_count += 1
-            except Exception as e:
-                fail_count += 1
-                failed_lines.append(f"❌ エラー（{invited_id}）: {str(e)}")
+        records, failed_lines = parse_invite_rows(rows)
+        success_count, insert_failed, unknown_ids = await insert_invites(records)
+        failed_lines.extend(insert_failed)
+        fail_count = len(failed_lines)
 
         result_message = (
             f"✅ 登録完了\n"
             f"- 成功: {success_count} 件\n"
             f"- 失敗: {fail_count} 件"
         )
+        if unknown_ids:
+            result_message += f"\n- 結果不明: {len(unknown_ids)} 件（登録済みか確認してから再実行してください）"
         if failed_lines:
             result_message += "\n" + "\n".join(failed_lines[:10])  # エラーは最大10件表示
+        if unknown_ids:
+            result_message += "\n⚠️ 結果不明: " + ", ".join(unknown_ids[:20])
 
         await ctx.send(result_message)
 
     except Exception as e:
         await ctx.send(f"❌ コマンドエラー: {str(e)}")
 
+# 添付ファイルからIDを読み込む（改行・カンマ・タブ・空白区切り）
+async def read_id_attachment(attachment: discord.Attachment) -> list[str]:
+    text = (await attachment.read()).decode("utf-8-sig")
+    return [token for token in re.split(r"[\s,]+", text) if token.isdigit()]
+
+# in_フィルタでチャンク単位に一括更新し、更新できたIDとできなかったIDを返す
+async def settle_invites(invited_ids: list[str]) -> tuple[list[str], list[str]]:
+    invited_ids = list(dict.fromkeys(invited_ids))  # 重複除去（順序は維持）
+    matched = set()
+    for chunk in chunked(invited_ids, SETTLE_CHUNK_SIZE):
+        response = await db.execute(
+            "mark_settled",
+            lambda c: c.table("invites").update({"settled": True}).in_("invited_id", chunk),
+        )
+        matched.update(str(row["invited_id"]) for row in response.data or [])
+    matched_ids = [i for i in invited_ids if i in matched]
+    unmatched_ids = [i for i in invited_ids if i not in matched]
+    return matched_ids, unmatched_ids
+
+async def send_settle_result(ctx, matched_ids: list[str], unmatched_ids: list[str]):
+    result_message = f"✅ {len(matched_ids)} 件のユーザーを定着済みに更新しました。"
+    if unmatched_ids:
+        result_message += f"\n⚠️ 該当なし: {len(unmatched_ids)} 件"
+        preview = ", ".join(unmatched_ids[:20])
+        result_message += f"\n{preview}" + (" ..." if len(unmatched_ids) > 20 else "")
+
+    # 件数が多い場合は一覧をファイルで添付
+    if len(matched_ids) + len(unmatched_ids) > 20:
+        report = "\n".join(
+            [f"{i},matched" for i in matched_ids] + [f"{i},unmatched" for i in unmatched_ids]
+        )
+        file = discord.File(io.BytesIO(report.encode("utf-8")), filename="mark_settled_result.csv")
+        await ctx.send(result_message, file=file)
+    else:
+        await ctx.send(result_message)
+
 @bot.command(name="mark_settled")
 @commands.has_permissions(manage_guild=True)
 async def mark_settled(ctx, *invited_ids: str):
     try:
-        updated = 0
-        for invited_id in invited_ids:
-            response = supabase.table("invites").update({"settled": True}).eq("invited_id", invited_id).execute()
-            if response.data:
-                updated += 1
-        await ctx.send(f"✅ {updated} 件のユーザーを定着済みに更新しました。")
+        ids = list(invited_ids)
+        for attachment in ctx.message.attachments:
+            ids.extend(await read_id_attachment(attachment))
+        if not ids:
+            await ctx.send("❌ 更新対象のIDが指定されていません。")
+            return
+
+        matched_ids, unmatched_ids = await settle_invites(ids)
+        await send_settle_result(ctx, matched_ids, unmatched_ids)
+    except Exception as e:
+        await ctx.send(f"❌ 更新に失敗しました: {e}")
+
+# 指定ロールを持つメンバー全員を定着済みにする
+@bot.command(name="mark_settled_role")
+@commands.has_permissions(manage_guild=True)
+async def mark_settled_role(ctx, role: discord.Role):
+    try:
+        ids = [str(m.id) for m in await members_with_role(ctx.guild, role.id)]
+        if not ids:
+            await ctx.send(f"❌ {role.name} ロールを持つメンバーがいません。")
+            return
+
+        matched_ids, unmatched_ids = await settle_invites(ids)
+        await send_settle_result(ctx, matched_ids, unmatched_ids)
     except Exception as e:
         await ctx.send(f"❌ 更新に失敗しました: {e}")
 
 # ✅ 通常コマンド：Googleスプレッドシートに集計出力
 from datetime import datetime, timedelta
 
+# 招待方法・性別・定着の組ごとの件数を取得する。
+# まずDB側で集計するRPC（supabase/invite_summary.sql）を使い、未導入ならページングしながら数える
+async def fetch_invite_counts(label: str, since: str, until: str = None) -> list[dict]:
+    try:
+        result = await db.execute(label, lambda c: c.rpc("invite_summary", {"since": since, "until": until}))
+        return result.data or []
+    except Exception as e:
+        log.warning("⚠️ invite_summary RPCが利用できないため、ページングで集計します: %s", e)
+
+    def query(c, offset: int):
+        q = c.table("invites").select("invite_method", "gender", "settled").gte("invited_at", since)
+        if until:
+            q = q.lte("invited_at", until)
+        return q.order("invited_at").order("invited_id").range(offset, offset + INVITE_PAGE_SIZE - 1)
+
+    counts = {}
+    offset = 0
+    while True:
+        result = await db.execute(label, lambda c: query(c, offset))
+        for row in result.data:
+            key = (row["invite_method"], row["gender"], bool(row.get("settled")))
+            counts[key] = counts.get(key, 0) + 1
+        if len(result.data) < INVITE_PAGE_SIZE:
+            break
+        offset += INVITE_PAGE_SIZE
+
+    return [
+        {"invite_method": method, "gender": gender, "settled": settled, "count": count}
+        for (method, gender, settled), count in counts.items()
+    ]
+
+async def output_sheets(ctx, title: str, summary: dict, settled_summary: dict, tab_title: str):
+    await sheets.write_table(build_summary_table(summary, settled_summary), tab_title)
+    await ctx.send("✅ 集計結果をGoogleスプレッドシートに出力しました。")
+
+async def output_csv(ctx, title: str, summary: dict, settled_summary: dict, tab_title: str):
+    data = table_to_csv(build_summary_table(summary, settled_summary))
+    await ctx.send(f"✅ {title}", file=discord.File(io.BytesIO(data), filename="invite_summary.csv"))
+
+async def output_embed(ctx, title: str, summary: dict, settled_summary: dict, tab_title: str):
+    await ctx.send(embed=build_summary_embed(title, summary, settled_summary))
+
+SUMMARY_OUTPUTS = {
+    "sheets": output_sheets,
+    "csv": output_csv,
+    "embed": output_embed,
+}
+
+# 集計の共通処理（取得 → 集約 → 出力）
+async def run_invite_summary(ctx, label: str, title: str, since: str, until: str, output: str, tab_title: str):
+    render = SUMMARY_OUTPUTS.get(output)
+    if render is None:
+        await ctx.send(f"❌ 出力先は {' / '.join(SUMMARY_OUTPUTS)} のいずれかを指定してください。")
+        return
+    rows = await fetch_invite_counts(label, since, until)
+    summary, settled_summary = summarize_invite_counts(rows)
+    await render(ctx, title, summary, settled_summary, tab_title)
+
+# output: sheets（スプレッドシート） / csv（ファイル添付） / embed（チャンネルに表示）
 @bot.command(name="export_invite_summary")
 @commands.has_permissions(manage_guild=True)
-async def export_invite_summary(ctx, days: int = 30):
+async def export_invite_summary(ctx, days: int = 30, output: str = "sheets", new_tab: bool = False):
     try:
         await ctx.send(f"📊 過去{days}日間の集計を開始します。しばらくお待ちください...")
 
         since_date = (datetime.utcnow() - timedelta(days=days)).isoformat()
-
-        result = supabase.table("invites") \
-            .select("invite_method", "gender", "settled", "invited_at") \
-            .gte("invited_at", since_date) \
-            .execute()
-        data = result.data
-
-
-        # 通常集計と定着数集計を分ける
-        summary = {}
-        settled_summary = {}
-        for row in data:
-            method = row["invite_method"]
-            gender = row["gender"]
-            settled = row.get("settled", False)
-
-            if method not in summary:
-                summary[method] = {"男性": 0, "女性": 0, "未入力": 0}
-                settled_summary[method] = {"男性": 0, "女性": 0, "未入力": 0}
-
-            summary[method][gender] += 1
-            if settled:
-                settled_summary[method][gender] += 1
-
-        # スプレッドシート出力
-        worksheet.clear()
-
-        # 1段目: 全体の集計
-        worksheet.append_row(["招待方法", "男性", "女性", "未入力", "合計"])
-        for method, counts in summary.items():
-            male = counts["男性"]
-            female = counts["女性"]
-            unknown = counts["未入力"]
-            total = male + female + unknown
-            worksheet.append_row([method, male, female, unknown, total])
-
-        # 空行
-        worksheet.append_row([])
-
-        # 2段目: 定着数と割合
-        worksheet.append_row(["定着数", "男性", "女性", "未入力", "男性割合", "女性割合"])
-        for method in summary:
-            settled = settled_summary.get(method, {"男性": 0, "女性": 0, "未入力": 0})
-            total = sum(summary[method].values())
-            male_rate = f"{round(settled['男性'] / summary[method]['男性'] * 100)}％" if summary[method]['男性'] > 0 else "0％"
-            female_rate = f"{round(settled['女性'] / summary[method]['女性'] * 100)}％" if summary[method]['女性'] > 0 else "0％"
-
-            worksheet.append_row([
-                method,
-                settled["男性"],
-                settled["女性"],
-                settled["未入力"],
-                male_rate,
-                female_rate
-            ])
-
-        await ctx.send("✅ 集計結果をGoogleスプレッドシートに出力しました。")
+        tab_title = f"{datetime.utcnow():%Y-%m-%d}_{days}d" if new_tab else None
+        await run_invite_summary(
+            ctx, "export_invite_summary", f"過去{days}日間の招待集計", since_date, None, output, tab_title
+        )
     except Exception as e:
         await ctx.send(f"❌ 出力に失敗しました: {e}")
 
 @bot.command(name="export_invite_summary_range")
 @commands.has_permissions(manage_guild=True)
-async def export_invite_summary_range(ctx, start_date: str, end_date: str):
+async def export_invite_summary_range(ctx, start_date: str, end_date: str, output: str = "sheets", new_tab: bool = False):
     try:
         await ctx.send(f"📊 {start_date}〜{end_date}の集計を開始します...")
 
-        result = supabase.table("invites") \
-            .select("invite_method", "gender", "settled", "invited_at") \
-            .gte("invited_at", start_date) \
-            .lte("invited_at", end_date) \
-            .execute()
-        data = result.data
-
-
-
-        # 通常集計と定着数集計を分ける
-        summary = {}
-        settled_summary = {}
-        for row in data:
-            method = row["invite_method"]
-            gender = row["gender"]
-            settled = row.get("settled", False)
-
-            if method not in summary:
-                summary[method] = {"男性": 0, "女性": 0, "未入力": 0}
-                settled_summary[method] = {"男性": 0, "女性": 0, "未入力": 0}
-
-            summary[method][gender] += 1
-            if settled:
-                settled_summary[method][gender] += 1
-
-        # スプレッドシート出力
-        worksheet.clear()
-
-        # 1段目: 全体の集計
-        worksheet.append_row(["招待方法", "男性", "女性", "未入力", "合計"])
-        for method, counts in summary.items():
-            male = counts["男性"]
-            female = counts["女性"]
-            unknown = counts["未入力"]
-            total = male + female + unknown
-            worksheet.append_row([method, male, female, unknown, total])
-
-        # 空行
-        worksheet.append_row([])
-
-        # 2段目: 定着数と割合
-        worksheet.append_row(["定着数", "男性", "女性", "未入力", "男性割合", "女性割合"])
-        for method in summary:
-            settled = settled_summary.get(method, {"男性": 0, "女性": 0, "未入力": 0})
-            total = sum(summary[method].values())
-            male_rate = f"{round(settled['男性'] / summary[method]['男性'] * 100)}％" if summary[method]['男性'] > 0 else "0％"
-            female_rate = f"{round(settled['女性'] / summary[method]['女性'] * 100)}％" if summary[method]['女性'] > 0 else "0％"
-
-            worksheet.append_row([
-                method,
-                settled["男性"],
-                settled["女性"],
-                settled["未入力"],
-                male_rate,
-                female_rate
-            ])
-
-        await ctx.send("✅ 集計結果をGoogleスプレッドシートに出力しました。")
+        tab_title = f"{start_date}_{end_date}" if new_tab else None
+        await run_invite_summary(
+            ctx, "export_invite_summary_range", f"{start_date}〜{end_date}の招待集計", start_date, end_date, output, tab_title
+        )
     except Exception as e:
         await ctx.send(f"❌ 出力に失敗しました: {e}")
 
-bot.run(TOKEN)
\ No newline at end of file
+# 通常は main.py から FastAPI と同じイベントループで起動する
+if __name__ == "__main__":
+    setup_logging(LOG_LEVEL, LOG_SAMPLE_RATES)
+    bot.run(TOKEN, log_handler=None)
@@ -0,0 +1,40 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+
+# 同期のSupabaseクライアントをスレッドプール上で実行し、イベントループを止めないためのラッパー
+class Database:
+    def __init__(self, client, max_workers: int = 4, timeout: float = 10.0, slow_threshold: float = 1.0):
+        self.client = client
+        self.timeout = timeout
+        self.slow_threshold = slow_threshold
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="supabase")
+
+    async def execute(self, label: str, build):
+        # build はクライアントを受け取りクエリビルダーを返す関数（例: lambda c: c.table("invites").select("*")）
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self._executor, lambda: build(self.client).execute()),
+                timeout=self.timeout,
+            )
+        except Exception:
+            REGISTRY.inc("supabase_errors_total", label=label)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            REGISTRY.observe("supabase_request_seconds", elapsed, label=label)
+            elapsed_ms = round(elapsed * 1000, 1)
+            # 遅いリクエストは間引かずに WARNING で残す
+            level = logging.WARNING if elapsed >= self.slow_threshold else logging.DEBUG
+            log.log(level, "⏱ Supabase %s: %sms", label, elapsed_ms, extra={"label": label, "elapsed_ms": elapsed_ms})
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,111 @@
+import asyncio
+import itertools
+import logging
+
+import discord
+
+from metrics import REGISTRY
+from throttle import Pacer
+
+log = logging.getLogger(__name__)
+
+# 優先度（小さいほど先に送る）。参加者が最後に待っている招待リンクを案内文より先に届ける
+PRIORITY_INVITE = 0
+PRIORITY_STEP = 1
+PRIORITY_NOTICE = 2
+
+
+# DM送信をキューに積み、ワーカーが優先度順に送る。チャンネルごと・ルートごとのレート制限（バケット）は
+# discord.py が処理するので、ここではDMチャンネルの作成とメッセージ送信を合わせた全体の頻度だけを
+# Discord のグローバル上限（50回/秒）より少し下に抑え、429/5xx は間隔を空けて再試行する。
+# DMチャンネルはユーザーIDごとにキャッシュする
+class DMOutbox:
+    def __init__(self, bot, rate: float = 40.0, workers: int = 8, max_retries: int = 5):
+        self.bot = bot
+        self.workers = workers
+        self.max_retries = max_retries
+        self.pacer = Pacer(rate)
+        self.channels: dict[int, discord.DMChannel] = {}
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._seq = itertools.count()  # 同じ優先度では先着順
+        self._tasks = []
+        self._opening: dict[int, asyncio.Task] = {}
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    # DMチャンネルを返す。キャッシュになければ作成する（同じユーザーの同時作成は1回にまとめる）
+    async def get_dm(self, user: discord.abc.User | int) -> discord.DMChannel:
+        user_id = user if isinstance(user, int) else user.id
+        channel = self.channels.get(user_id)
+        if channel is not None:
+            return channel
+        if not isinstance(user, int) and user.dm_channel is not None:
+            self.channels[user_id] = user.dm_channel
+            return user.dm_channel
+        task = self._opening.get(user_id)
+        if task is None:
+            task = self._opening[user_id] = asyncio.create_task(self._open_dm(user))
+            task.add_done_callback(lambda _: self._opening.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _open_dm(self, user: discord.abc.User | int) -> discord.DMChannel:
+        if isinstance(user, int):
+            user = self.bot.get_user(user) or await self.bot.fetch_user(user)
+        channel = await self._with_retry("create_dm", user.create_dm)
+        self.channels[user.id] = channel
+        return channel
+
+    # 送信をキューに積み、送信結果（Message）を返す Future を返す。
+    # 順番が大事な送信は await し、投げっぱなしでよい送信はそのままにしてよい
+    def send(self, target, content: str = None, *, view: discord.ui.View = None,
+             priority: int = PRIORITY_NOTICE) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # 失敗は _worker で記録するので、誰も await しなくても未取得の例外として警告させない
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._queue.put_nowait((priority, next(self._seq), loop.time(), target, content, view, future))
+        return future
+
+    def start(self):
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, _, enqueued_at, target, content, view, future = await self._queue.get()
+            try:
+                # ユーザー（またはユーザーID）ならDMチャンネルを引き、チャンネルならそのまま送る
+                if isinstance(target, int) or hasattr(target, "create_dm"):
+                    channel = await self.get_dm(target)
+                else:
+                    channel = target
+                message = await self._with_retry("send", lambda: channel.send(content, view=view))
+                REGISTRY.inc("dm_sent_total", priority=str(priority))
+                if not future.done():
+                    future.set_result(message)
+            except Exception as e:
+                REGISTRY.inc("dm_failed_total", priority=str(priority))
+                if not future.done():
+                    future.set_exception(e)
+                log.error("❌ DM送信失敗（%s）: %s", target, e, extra={"member_id": getattr(target, "id", target), "priority": priority})
+            finally:
+                # キューでの待ち時間を含めた、積んでから送り終わるまでの時間
+                REGISTRY.observe("dm_send_seconds", loop.time() - enqueued_at, priority=str(priority))
+                self._queue.task_done()
+
+    # 429 と 5xx は指数バックオフで再試行する（403 などはそのまま失敗）
+    async def _with_retry(self, route: str, call):
+        for attempt in range(self.max_retries):
+            await self.pacer.wait()
+            try:
+                return await call()
+            except discord.HTTPException as e:
+                if not (e.status == 429 or e.status >= 500) or attempt == self.max_retries - 1:
+                    raise
+                REGISTRY.inc("dm_retries_total", route=route, status=str(e.status))
+                delay = 2 ** attempt
+                log.warning("⚠️ %s が %s で失敗しました（%s秒後に再試行）", route, e.status, delay, extra={"route": route, "status": e.status})
+                await asyncio.sleep(delay)
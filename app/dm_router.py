@@ -0,0 +1,24 @@
+import discord
+
+
+# DMで届いたテキストを、ユーザーIDをキーにして購読中のハンドラーへ振り分ける。
+# 質問ごとに bot.wait_for のリスナーを登録せず、メッセージ1件あたり辞書引き1回で済ませる
+class DMReplyRouter:
+    def __init__(self):
+        self._handlers: dict[int, object] = {}
+
+    def subscribe(self, user_id: int, handler):
+        self._handlers[user_id] = handler
+
+    def unsubscribe(self, user_id: int):
+        self._handlers.pop(user_id, None)
+
+    # 処理した場合は True を返す（False ならコマンドとして処理を続ける）
+    async def dispatch(self, message: discord.Message) -> bool:
+        handler = self._handlers.get(message.author.id)
+        if handler is None:
+            return False
+        return await handler(message)
+
+    def __len__(self):
+        return len(self._handlers)
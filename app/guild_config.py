@@ -0,0 +1,105 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+# !set_guild_config で変更できる項目（キー → GuildConfig の属性）。role.<キー> / role_name.<キー> はロールごとに指定する
+SETTABLE_FIELDS = {
+    "inviter_guild": "inviter_guild_id",
+    "inviter_role": "inviter_role_id",
+    "invite_url": "invite_url",
+    "admin_user": "admin_user_id",
+    "admin_channel": "admin_channel_id",
+}
+
+
+def _to_int(value) -> int | None:
+    return int(value) if value not in (None, "") else None
+
+
+# ギルドごとの設定（ファネルのロール、招待者ロール、招待リンクの元メッセージ、管理者への通知先）
+class GuildConfig:
+    def __init__(self, guild_id: int | None, role_names: dict[str, str], role_ids: dict[str, int],
+                 inviter_guild_id: int | None, inviter_role_id: int | None, invite_url: str | None,
+                 admin_user_id: int | None, admin_channel_id: int | None = None):
+        self.guild_id = guild_id
+        self.role_names = role_names
+        self.role_ids = role_ids
+        self.inviter_guild_id = inviter_guild_id
+        self.inviter_role_id = inviter_role_id
+        self.invite_url = invite_url
+        self.admin_user_id = admin_user_id
+        self.admin_channel_id = admin_channel_id
+
+    # Supabaseの行から作る。行で未指定（null）の項目は defaults の値を使う
+    @classmethod
+    def from_row(cls, row: dict, defaults: "GuildConfig") -> "GuildConfig":
+        guild_id = int(row["guild_id"])
+        return cls(
+            guild_id=guild_id,
+            role_names={**defaults.role_names, **(row.get("role_names") or {})},
+            role_ids={**defaults.role_ids, **{key: int(value) for key, value in (row.get("role_ids") or {}).items()}},
+            inviter_guild_id=_to_int(row.get("inviter_guild_id")) or defaults.inviter_guild_id or guild_id,
+            inviter_role_id=_to_int(row.get("inviter_role_id")) or defaults.inviter_role_id,
+            invite_url=row.get("invite_url") or defaults.invite_url,
+            admin_user_id=_to_int(row.get("admin_user_id")) or defaults.admin_user_id,
+            admin_channel_id=_to_int(row.get("admin_channel_id")) or defaults.admin_channel_id,
+        )
+
+    def for_guild(self, guild_id: int) -> "GuildConfig":
+        return GuildConfig(
+            guild_id, self.role_names, self.role_ids, self.inviter_guild_id or guild_id, self.inviter_role_id,
+            self.invite_url, self.admin_user_id, self.admin_channel_id,
+        )
+
+    def describe(self) -> list[str]:
+        lines = [f"{key}: {getattr(self, attr)}" for key, attr in SETTABLE_FIELDS.items()]
+        for key, name in self.role_names.items():
+            lines.append(f"role.{key}: {self.role_ids.get(key) or '-'}（{name}）")
+        return lines
+
+
+# guild_configs テーブルの設定をメモリに持つ。行のないギルドは環境変数から作った既定の設定を使うので、
+# 1つのサーバーだけで動かしている場合はテーブルが空のままでよい
+class GuildConfigStore:
+    def __init__(self, db, defaults: GuildConfig):
+        self.db = db
+        self.defaults = defaults
+        self.rows: dict[int, dict] = {}
+        self._configs: dict[int, GuildConfig] = {}
+
+    async def load(self) -> int:
+        result = await self.db.execute("load_guild_configs", lambda c: c.table("guild_configs").select("*"))
+        self.rows = {int(row["guild_id"]): row for row in result.data or []}
+        self._configs = {guild_id: GuildConfig.from_row(row, self.defaults) for guild_id, row in self.rows.items()}
+        return len(self._configs)
+
+    def get(self, guild_id: int) -> GuildConfig:
+        config = self._configs.get(guild_id)
+        if config is None:
+            config = self._configs[guild_id] = self.defaults.for_guild(guild_id)
+        return config
+
+    # 1項目を変更して保存する。key は SETTABLE_FIELDS のキー、または role.<キー> / role_name.<キー>。
+    # value に空文字を渡すと既定値に戻す
+    async def set(self, guild_id: int, key: str, value: str) -> GuildConfig:
+        row = dict(self.rows.get(guild_id) or {"guild_id": str(guild_id)})
+        prefix, _, role_key = key.partition(".")
+        if prefix in ("role", "role_name") and role_key in self.defaults.role_names:
+            column = "role_ids" if prefix == "role" else "role_names"
+            values = dict(row.get(column) or {})
+            if value:
+                values[role_key] = str(int(value)) if prefix == "role" else value
+            else:
+                values.pop(role_key, None)
+            row[column] = values
+        elif key in SETTABLE_FIELDS:
+            column = SETTABLE_FIELDS[key]
+            row[column] = (value if column == "invite_url" else str(int(value))) if value else None
+        else:
+            raise ValueError(f"未対応の設定項目です: {key}")
+
+        await self.db.execute("save_guild_config", lambda c: c.table("guild_configs").upsert(row))
+        self.rows[guild_id] = row
+        self._configs[guild_id] = GuildConfig.from_row(row, self.defaults)
+        log.info("ギルド設定を更新しました: %s", key, extra={"guild_id": guild_id})
+        return self._configs[guild_id]
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import re
+import time
+
+import discord
+
+from dm_outbox import PRIORITY_INVITE
+
+log = logging.getLogger(__name__)
+
+INVALID_INVITE_TEXT = """この招待リンクは現在無効です。
+管理者から新しいリンクが送付されるまでしばらくお待ちください。"""
+
+
+# INVITE_URL が指すメッセージと招待リンクの有効性をTTL付きでキャッシュする。
+# 招待送信のたびに fetch_channel / fetch_message / fetch_invite を呼ばず、DM送信1回で済ませる
+class InviteMessageCache:
+    def __init__(self, bot, outbox, invite_url: str, admin_user_id: int, admin_channel_id: int = None,
+                 ttl: float = 300.0, retry_after: float = 30.0):
+        self.bot = bot
+        self.outbox = outbox
+        self.admin_user_id = admin_user_id
+        self.admin_channel_id = admin_channel_id
+        self.ttl = ttl
+        self.retry_after = retry_after
+        match = re.search(r'discord\.com/channels/(\d+)/(\d+)/(\d+)', invite_url or "")
+        self.ids = tuple(map(int, match.groups())) if match else None
+
+        self.content = None  # 有効な場合にDMで送る本文
+        self.error_text = "招待リンクが無効です。" if self.ids is None else None
+        self.invite_code = None
+        self.invite_valid = False
+        self.expires_at = 0.0
+        self.alerted = False
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._pending = None
+
+    @property
+    def message_link(self) -> str:
+        guild_id, channel_id, message_id = self.ids
+        return f"https://discord.com/channels/{guild_id}/{channel_id}/{message_id}"
+
+    async def refresh(self):
+        if self.ids is None:
+            return
+        _, channel_id, message_id = self.ids
+        ttl = self.ttl
+        try:
+            # メッセージ取得
+            channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+            message = await channel.fetch_message(message_id)
+
+            # 招待リンクを抽出
+            invite_match = re.search(r'(https?://)?(www\.)?(discord\.gg|discord\.com/invite)/[a-zA-Z0-9]+', message.content)
+            if invite_match:
+                try:
+                    # 招待の有効性を確認
+                    invite = await self.bot.fetch_invite(invite_match.group(0))
+                    self.content = message.content
+                    self.invite_code = invite.code
+                    self.invite_valid = True
+                    self.error_text = None
+                    self.alerted = False
+                except discord.NotFound:
+                    self.invite_valid = False
+                    self.error_text = INVALID_INVITE_TEXT
+            else:
+                self.invite_valid = False
+                self.error_text = "メッセージに招待リンクが含まれていません。"
+
+        except discord.NotFound:
+            self.invite_valid = False
+            self.error_text = "指定されたメッセージが見つかりませんでした。"
+        except discord.Forbidden:
+            self.invite_valid = False
+            self.error_text = "メッセージにアクセスする権限がありません。"
+        except Exception as e:
+            # 一時的なエラーは短い間隔で再取得する。有効と確認済みのリンクがあればそれを送り続ける
+            if not self.invite_valid:
+                self.error_text = f"メッセージ取得中にエラーが発生しました：{e}"
+            log.warning("⚠️ 招待メッセージの取得に失敗しました（%s秒後に再取得）: %s", self.retry_after, e)
+            ttl = self.retry_after
+        self.expires_at = time.monotonic() + ttl
+
+    async def get(self):
+        if time.monotonic() >= self.expires_at:
+            async with self._lock:
+                # 待っている間に他のタスクが更新していれば再取得しない
+                if time.monotonic() >= self.expires_at:
+                    await self.refresh()
+        return self
+
+    def invalidate(self):
+        self.expires_at = 0.0
+        self._pending = asyncio.create_task(self.get())
+
+    def on_message_edit(self, message_id: int):
+        if self.ids and message_id == self.ids[2]:
+            self.invalidate()
+
+    def on_invite_delete(self, code: str):
+        if code == self.invite_code:
+            self.invalidate()
+
+    # TTLごとにバックグラウンドで更新し、参加者の処理中に取得待ちが発生しないようにする
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                async with self._lock:
+                    await self.refresh()
+            except Exception as e:
+                log.exception("⚠️ 招待メッセージの更新に失敗しました: %s", e)
+            await asyncio.sleep(max(1.0, self.expires_at - time.monotonic()))
+
+    # 招待リンクは他の案内より優先して送る。user_id は管理者への通知に載せる参加者のID
+    # （インタラクション経由のDMチャンネルは recipient が入っていないことがあるため、チャンネルからは取らない）
+    async def send(self, dm_channel, user_id: int):
+        await self.get()
+        if self.invite_valid:
+            self.outbox.send(dm_channel, self.content, priority=PRIORITY_INVITE)
+            return
+        self.outbox.send(dm_channel, self.error_text, priority=PRIORITY_INVITE)
+        if self.error_text == INVALID_INVITE_TEXT:
+            await self.alert_admin(user_id)
+
+    # 無効になった招待リンクの通知は、再び有効になるまで1回だけ送る。
+    # 管理チャンネルが設定されていればそこへ、なければ管理者にDMで送る
+    async def alert_admin(self, user_id: int):
+        if self.alerted:
+            return
+        self.alerted = True
+        try:
+            if self.admin_channel_id:
+                target = self.bot.get_channel(self.admin_channel_id) or await self.bot.fetch_channel(self.admin_channel_id)
+            else:
+                target = self.bot.get_user(self.admin_user_id) or await self.bot.fetch_user(self.admin_user_id)
+            await target.send(
+                f"⚠️ 無効な招待リンクが使用されました。\n"
+                f"・元メッセージリンク: {self.message_link}\n"
+                f"・対象ユーザー: {self.bot.get_user(user_id) or f'<@{user_id}>'} (`{user_id}`)\n"
+                f"・リンクが更新されるまで以降の通知は省略します。"
+            )
+        except Exception as e:
+            self.alerted = False
+            log.warning("⚠️ 管理者への通知に失敗しました: %s", e)
+
+
+# ギルドの設定（invite_url と通知先）ごとの InviteMessageCache。同じ設定のギルドは1つのキャッシュを共有する
+class InviteMessageCaches:
+    def __init__(self, bot, outbox, configs, ttl: float = 300.0):
+        self.bot = bot
+        self.outbox = outbox
+        self.configs = configs
+        self.ttl = ttl
+        self._caches: dict[tuple, InviteMessageCache] = {}
+        self._started = False
+
+    def for_guild(self, guild_id: int) -> InviteMessageCache:
+        config = self.configs.get(guild_id)
+        key = (config.invite_url, config.admin_user_id, config.admin_channel_id)
+        cache = self._caches.get(key)
+        if cache is None:
+            cache = self._caches[key] = InviteMessageCache(
+                self.bot, self.outbox, config.invite_url, config.admin_user_id, config.admin_channel_id, ttl=self.ttl
+            )
+            if self._started:
+                cache.start()
+        return cache
+
+    def start(self, guild_ids):
+        self._started = True
+        for guild_id in guild_ids:
+            self.for_guild(guild_id)
+        for cache in self._caches.values():
+            cache.start()
+
+    def on_message_edit(self, message_id: int):
+        for cache in self._caches.values():
+            cache.on_message_edit(message_id)
+
+    def on_invite_delete(self, code: str):
+        for cache in self._caches.values():
+            cache.on_invite_delete(code)
+
+    # 設定が変わったときは作り直す（次の参照時に組み立てる）
+    def reset(self):
+        for cache in self._caches.values():
+            cache.stop()
+        self._caches.clear()
@@ -0,0 +1,86 @@
+import csv
+import io
+
+import discord
+
+GENDERS = ["男性", "女性", "未入力"]
+
+
+def format_rate(settled: int, total: int) -> str:
+    return f"{round(settled / total * 100)}％" if total > 0 else "0％"
+
+# 通常集計と定着数集計を分ける
+def summarize_invite_counts(rows: list[dict]) -> tuple[dict, dict]:
+    summary = {}
+    settled_summary = {}
+    for row in rows:
+        method = row["invite_method"]
+        gender = row["gender"]
+        count = row["count"]
+
+        if method not in summary:
+            summary[method] = dict.fromkeys(GENDERS, 0)
+            settled_summary[method] = dict.fromkeys(GENDERS, 0)
+
+        summary[method][gender] += count
+        if row.get("settled"):
+            settled_summary[method][gender] += count
+    return summary, settled_summary
+
+# 集計結果をシートに書き込む2次元の表に変換する
+def build_summary_table(summary: dict, settled_summary: dict) -> list[list]:
+    # 1段目: 全体の集計
+    table = [["招待方法", "男性", "女性", "未入力", "合計"]]
+    for method, counts in summary.items():
+        male = counts["男性"]
+        female = counts["女性"]
+        unknown = counts["未入力"]
+        total = male + female + unknown
+        table.append([method, male, female, unknown, total])
+
+    # 空行
+    table.append([])
+
+    # 2段目: 定着数と割合
+    table.append(["定着数", "男性", "女性", "未入力", "男性割合", "女性割合"])
+    for method in summary:
+        settled = settled_summary.get(method, dict.fromkeys(GENDERS, 0))
+        male_rate = format_rate(settled["男性"], summary[method]["男性"])
+        female_rate = format_rate(settled["女性"], summary[method]["女性"])
+
+        table.append([
+            method,
+            settled["男性"],
+            settled["女性"],
+            settled["未入力"],
+            male_rate,
+            female_rate
+        ])
+    return table
+
+def table_to_csv(table: list[list]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(table)
+    return buffer.getvalue().encode("utf-8-sig")  # Excelで文字化けしないようBOM付き
+
+# Embedはフィールド25個までなので、超えた分は省略する
+def build_summary_embed(title: str, summary: dict, settled_summary: dict) -> discord.Embed:
+    embed = discord.Embed(title=title, color=discord.Color.blue())
+    methods = list(summary.items())
+    for method, counts in methods[:25]:
+        settled = settled_summary.get(method, dict.fromkeys(GENDERS, 0))
+        embed.add_field(
+            name=method,
+            value=(
+                f"男性 {counts['男性']} / 女性 {counts['女性']} / 未入力 {counts['未入力']} / 合計 {sum(counts.values())}\n"
+                f"定着: 男性 {settled['男性']}（{format_rate(settled['男性'], counts['男性'])}）"
+                f" / 女性 {settled['女性']}（{format_rate(settled['女性'], counts['女性'])}）"
+                f" / 未入力 {settled['未入力']}"
+            ),
+            inline=False,
+        )
+    if len(methods) > 25:
+        embed.set_footer(text=f"他 {len(methods) - 25} 件の招待方法は省略されました。CSV出力をご利用ください。")
+    if not methods:
+        embed.description = "対象期間の招待データはありません。"
+    return embed
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+
+import discord
+
+from member_cache import members_with_role
+
+log = logging.getLogger(__name__)
+
+
+# 招待者ロールを持つメンバーの一覧（ID → 表示名）をキャッシュする。
+# 質問開始のたびに role.members を走査せず、on_member_update などの差分で更新する。
+# チャンクしていないギルドでは load() でメンバー一覧APIから組み立てる
+class InviterRoster:
+    def __init__(self, role_id: int):
+        self.role_id = role_id
+        self._members: dict[str, str] = {}
+        self._sorted: tuple[tuple[str, str], ...] | None = None
+
+    def build(self, guild: discord.Guild):
+        role = guild.get_role(self.role_id)
+        if role is None:
+            log.warning("⚠️ 招待者ロールが見つかりません: %s（%s）", self.role_id, guild.name, extra={"guild_id": guild.id})
+            self.set_members([])
+        else:
+            self.set_members(role.members)
+
+    async def load(self, guild: discord.Guild):
+        if guild.chunked or guild.get_role(self.role_id) is None:
+            self.build(guild)
+            return
+        self.set_members(await members_with_role(guild, self.role_id))
+
+    def set_members(self, members):
+        self._members = {str(m.id): m.display_name for m in members}
+        self._sorted = None
+
+    def is_inviter(self, member: discord.Member) -> bool:
+        return member.get_role(self.role_id) is not None
+
+    def update(self, member: discord.Member):
+        member_id = str(member.id)
+        if self.is_inviter(member):
+            if self._members.get(member_id) != member.display_name:
+                self._members[member_id] = member.display_name
+                self._sorted = None
+        elif member_id in self._members:
+            del self._members[member_id]
+            self._sorted = None
+
+    def remove(self, member_id: int):
+        if self._members.pop(str(member_id), None) is not None:
+            self._sorted = None
+
+    def get_name(self, inviter_id: str) -> str | None:
+        return self._members.get(inviter_id)
+
+    # 名前順の一覧。変更があるまで同じタプルを使い回す
+    def sorted_items(self) -> tuple[tuple[str, str], ...]:
+        if self._sorted is None:
+            self._sorted = tuple(sorted(self._members.items(), key=lambda item: item[1].casefold()))
+        return self._sorted
+
+    def __len__(self):
+        return len(self._members)
+
+
+# ギルドごとの招待者一覧。参加者のギルドの設定（inviter_guild_id / inviter_role_id）から一覧を引く。
+# 同じ招待者ロールを使うギルド同士は1つの一覧を共有する。
+# 招待者のギルドをチャンクしていない場合は読み込みをバックグラウンドで行い、ensure() で完了を待てる
+class InviterRosters:
+    def __init__(self, bot, configs):
+        self.bot = bot
+        self.configs = configs
+        self._rosters: dict[tuple[int, int], InviterRoster] = {}  # (招待者のギルドID, ロールID) → 一覧
+        self._loading: dict[tuple[int, int], asyncio.Task] = {}
+
+    def _key(self, guild_id: int) -> tuple[int, int]:
+        config = self.configs.get(guild_id)
+        return config.inviter_guild_id, config.inviter_role_id
+
+    # 読み込み中の場合は途中（空のこともある）の一覧を返す
+    def for_guild(self, guild_id: int) -> InviterRoster:
+        key = self._key(guild_id)
+        roster = self._rosters.get(key)
+        if roster is None:
+            roster = self._rosters[key] = InviterRoster(key[1])
+            guild = self.bot.get_guild(key[0])
+            if guild is not None:
+                self._load(key, roster, guild)
+        return roster
+
+    # 読み込みが終わった一覧を返す
+    async def ensure(self, guild_id: int) -> InviterRoster:
+        roster = self.for_guild(guild_id)
+        task = self._loading.get(self._key(guild_id))
+        if task is not None:
+            await asyncio.shield(task)
+        return roster
+
+    def _load(self, key: tuple[int, int], roster: InviterRoster, guild: discord.Guild) -> asyncio.Task | None:
+        if guild.chunked:
+            roster.build(guild)
+            return None
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = asyncio.create_task(self._fetch(roster, guild))
+            task.add_done_callback(lambda t: self._loading.get(key) is t and self._loading.pop(key))
+        return task
+
+    async def _fetch(self, roster: InviterRoster, guild: discord.Guild):
+        try:
+            await roster.load(guild)
+            log.info("✅ 招待者一覧を読み込みました: %s 人（%s）", len(roster), guild.name, extra={"guild_id": guild.id})
+        except Exception as e:
+            log.warning("⚠️ 招待者一覧の読み込みに失敗しました（%s）: %s", guild.name, e, extra={"guild_id": guild.id})
+
+    # guild が招待者のギルドになっている一覧のキー（作成済みの一覧と、guild_ids の各ギルドの設定から）
+    def keys_for(self, guild: discord.Guild, guild_ids) -> set[tuple[int, int]]:
+        keys = {self._key(guild_id) for guild_id in guild_ids} | set(self._rosters)
+        return {key for key in keys if key[0] == guild.id}
+
+    # 呼び出し側でまとめて取得したロールごとのメンバー（member_cache.members_with_roles の結果）で一覧を作り直す
+    def fill(self, guild: discord.Guild, guild_ids, members_by_role: dict[int, list[discord.Member]]):
+        for key in self.keys_for(guild, guild_ids):
+            roster = self._rosters.get(key)
+            if roster is None:
+                roster = self._rosters[key] = InviterRoster(key[1])
+            roster.set_members(members_by_role.get(key[1], []))
+
+    async def rebuild(self, guild: discord.Guild):
+        tasks = [
+            self._load(key, roster, guild)
+            for key, roster in list(self._rosters.items())
+            if key[0] == guild.id
+        ]
+        await asyncio.gather(*(task for task in tasks if task is not None))
+
+    def update(self, member: discord.Member):
+        for (guild_id, _), roster in self._rosters.items():
+            if guild_id == member.guild.id:
+                roster.update(member)
+
+    def remove(self, guild_id: int, member_id: int):
+        for (inviter_guild_id, _), roster in self._rosters.items():
+            if inviter_guild_id == guild_id:
+                roster.remove(member_id)
+
+    # 設定が変わったときは作り直す（次の参照時に組み立てる）
+    def reset(self):
+        self._rosters.clear()
+        self._loading.clear()
@@ -0,0 +1,87 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# LogRecord の標準属性。これ以外（extra で渡したもの）は JSON のフィールドとして出力する
+_STANDARD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "taskName"}
+
+
+# 1行1件の JSON に整形する（member_id / step / elapsed_ms などは extra で渡す）
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# ロガー名ごとに INFO 以下のログを間引く（WARNING 以上は常に出す）。
+# rates は {"database": 0.1} のように、残す割合を指定する
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+
+# キューに積む前の処理を最小限にする QueueHandler。標準の prepare は呼び出し元（イベントループ）のスレッドで
+# format() を呼び、トレースバックを msg に埋め込んで exc_info を消してしまうので、
+# ここでは msg と args の結合だけを行い、exc_info はそのまま QueueListener のスレッドに渡して整形させる
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)  # 他のハンドラーに渡るレコードは変えない
+        record.msg = record.getMessage()  # 後で args の中身が変わっても送った時点の内容で出す
+        record.args = None
+        return record
+
+
+# "database=0.1,dm_outbox=0.5" の形式をパースする
+def parse_sample_rates(spec: str) -> dict[str, float]:
+    rates = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            name, rate = part.split("=", 1)
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+# ルートロガーに QueueHandler を付け、整形と書き出しは QueueListener のスレッドで行う。
+# イベントループ側はレコードをキューに積むだけなので、大量の参加が重なっても出力で詰まらない
+def setup_logging(level: str = "INFO", sample_rates: dict[str, float] = None, stream=None) -> logging.handlers.QueueListener:
+    log_queue = queue.SimpleQueue()
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JSONFormatter())
+
+    queue_handler = _QueueHandler(log_queue)
+    if sample_rates:
+        queue_handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,49 @@
+import asyncio
+import contextlib
+import os
+import signal
+
+import uvicorn
+
+from bot import bot, TOKEN, LOG_LEVEL, LOG_SAMPLE_RATES
+from json_logging import setup_logging
+from server import app
+
+PORT = int(os.getenv("PORT", "8080"))
+
+
+# シグナルは main() 側で受けて、ボットとサーバーをまとめて止める
+class EmbeddedServer(uvicorn.Server):
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
+
+# Discordクライアントと FastAPI（uvicorn）を同じイベントループで動かす。
+# どちらかが止まればもう一方も止め、プロセスごと終了する
+async def main():
+    server = EmbeddedServer(uvicorn.Config(app, host="0.0.0.0", port=PORT, lifespan="off", log_config=None))
+
+    def stop():
+        server.should_exit = True
+        asyncio.create_task(bot.close())
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop)
+
+    async with bot:
+        bot_task = asyncio.create_task(bot.start(TOKEN), name="discord")
+        server_task = asyncio.create_task(server.serve(), name="uvicorn")
+        done, _ = await asyncio.wait({bot_task, server_task}, return_when=asyncio.FIRST_COMPLETED)
+        stop()
+        await asyncio.gather(bot_task, server_task, return_exceptions=True)
+        for task in done:
+            if task.exception():
+                raise task.exception()
+
+
+if __name__ == "__main__":
+    # discord.py と uvicorn のログも同じJSONの出力にまとめる
+    setup_logging(LOG_LEVEL, LOG_SAMPLE_RATES)
+    asyncio.run(main())
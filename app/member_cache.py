@@ -0,0 +1,64 @@
+import logging
+
+import discord
+
+log = logging.getLogger(__name__)
+
+QUERY_BATCH_SIZE = 100  # query_members に1回で渡せるユーザーIDの上限
+
+
+# MEMBER_CACHE の値から discord.py のメンバーキャッシュ方針を作る。
+# all: 全メンバーを持つ（従来どおり） / joined: 参加・更新・チャンクで届いたメンバーと、cache_members で入れたメンバーだけ持つ。
+# キャッシュにいないメンバーのアイコン変更やロール変更はイベントが届かないので、キャッシュを持たない設定は選べない
+def member_cache_flags(mode: str, intents: discord.Intents) -> discord.MemberCacheFlags:
+    mode = (mode or "all").lower()
+    if mode == "all":
+        return discord.MemberCacheFlags.from_intents(intents)
+    if mode == "joined":
+        flags = discord.MemberCacheFlags.none()
+        flags.joined = True
+        return flags
+    raise ValueError(f"MEMBER_CACHE は all / joined のいずれかを指定してください: {mode}")
+
+
+# キャッシュにいなければAPIから取得する（退出済みなら None）
+async def get_or_fetch_member(guild: discord.Guild, member_id: int) -> discord.Member | None:
+    member = guild.get_member(member_id)
+    if member is not None:
+        return member
+    try:
+        return await guild.fetch_member(member_id)
+    except discord.NotFound:
+        return None
+
+
+# ロールごとのメンバーの一覧（ロールID → メンバー）。チャンク済みのギルドはキャッシュから、
+# そうでなければメンバー一覧API（1000人ごとに1リクエスト）を1回だけ走査して、まとめて振り分ける
+async def members_with_roles(guild: discord.Guild, role_ids) -> dict[int, list[discord.Member]]:
+    roles = [role for role in map(guild.get_role, set(role_ids)) if role is not None]
+    if not roles:
+        return {}
+    if guild.chunked:
+        return {role.id: list(role.members) for role in roles}
+    result = {role.id: [] for role in roles}
+    async for member in guild.fetch_members(limit=None):
+        for role in roles:
+            if member.get_role(role.id) is not None:
+                result[role.id].append(member)
+    log.debug("ロールのメンバーをAPIから取得しました（%s）", {r.name: len(result[r.id]) for r in roles}, extra={"guild_id": guild.id})
+    return result
+
+
+async def members_with_role(guild: discord.Guild, role_id: int) -> list[discord.Member]:
+    return (await members_with_roles(guild, [role_id])).get(role_id, [])
+
+
+# キャッシュにいないメンバーをゲートウェイで照会してキャッシュに入れる（100人ごとに1リクエスト）。
+# キャッシュにいれば以後の GUILD_MEMBER_UPDATE で on_user_update / on_member_update が届く
+async def cache_members(guild: discord.Guild, members) -> int:
+    if guild.chunked:
+        return 0
+    user_ids = list({member.id for member in members if guild.get_member(member.id) is None})
+    for start in range(0, len(user_ids), QUERY_BATCH_SIZE):
+        await guild.query_members(user_ids=user_ids[start:start + QUERY_BATCH_SIZE], limit=QUERY_BATCH_SIZE, cache=True)
+    return len(user_ids)
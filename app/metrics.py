@@ -0,0 +1,175 @@
+import asyncio
+import math
+import re
+import time
+from contextlib import contextmanager
+
+import aiohttp
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# プロセス内のメトリクス（カウンター・ゲージ・ヒストグラム）を集める。
+# ボットとFastAPIは同じイベントループで動くので、server.py は REGISTRY を直接読む
+class Registry:
+    def __init__(self):
+        self._counters: dict[tuple, float] = {}
+        self._gauges: dict[tuple, float] = {}
+        self._gauge_fns: dict[str, object] = {}
+        self._histograms: dict[tuple, dict] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self._gauges[self._key(name, labels)] = value
+
+    # snapshot() のたびに呼び出して値を取るゲージ
+    def gauge_fn(self, name: str, fn):
+        self._gauge_fns[name] = fn
+
+    def observe(self, name: str, value: float, buckets=DEFAULT_BUCKETS, **labels):
+        key = self._key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = {"buckets": list(buckets), "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(histogram["buckets"]):
+            if value <= bound:
+                histogram["counts"][i] += 1
+                break
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        gauges = dict(self._gauges)
+        for name, fn in self._gauge_fns.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if value is not None and math.isfinite(value):
+                gauges[(name, ())] = value
+        return {
+            "updated_at": time.time(),
+            "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in self._counters.items()],
+            "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in gauges.items()],
+            "histograms": [{"name": n, "labels": dict(l), **h} for (n, l), h in self._histograms.items()],
+        }
+
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(labels: dict, extra: dict = None) -> str:
+    merged = {**labels, **(extra or {})}
+    if not merged:
+        return ""
+    body = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in merged.items())
+    return "{" + body + "}"
+
+
+# Prometheus のテキスト形式に変換する
+def render_prometheus(snapshot: dict) -> str:
+    lines = []
+    typed = set()
+
+    def type_line(name: str, kind: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for item in snapshot["counters"]:
+        type_line(item["name"], "counter")
+        lines.append(f"{item['name']}{_format_labels(item['labels'])} {item['value']}")
+    for item in snapshot["gauges"]:
+        type_line(item["name"], "gauge")
+        lines.append(f"{item['name']}{_format_labels(item['labels'])} {item['value']}")
+    for item in snapshot["histograms"]:
+        name = item["name"]
+        type_line(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(item["buckets"], item["counts"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(item['labels'], {'le': bound})} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(item['labels'], {'le': '+Inf'})} {item['count']}")
+        lines.append(f"{name}_sum{_format_labels(item['labels'])} {item['sum']}")
+        lines.append(f"{name}_count{_format_labels(item['labels'])} {item['count']}")
+    return "\n".join(lines) + "\n"
+
+
+# バケットから分位点を概算する（該当バケットの上限を返す。最大のバケットを超える場合はその上限）
+def estimate_quantile(histogram: dict, q: float) -> float | None:
+    if histogram["count"] == 0:
+        return None
+    target = q * histogram["count"]
+    cumulative = 0
+    for bound, count in zip(histogram["buckets"], histogram["counts"]):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return histogram["buckets"][-1]
+
+
+def _series_name(item: dict) -> str:
+    return item["name"] + _format_labels(item["labels"])
+
+
+# /status 用の要約（ゲージ・カウンターと、各レイテンシーの件数・平均・p50・p99）
+def summarize(snapshot: dict) -> dict:
+    return {
+        "updated_at": snapshot["updated_at"],
+        "age_seconds": round(time.time() - snapshot["updated_at"], 3),
+        "gauges": {_series_name(item): item["value"] for item in snapshot["gauges"]},
+        "counters": {_series_name(item): item["value"] for item in snapshot["counters"]},
+        "latency": {
+            _series_name(item): {
+                "count": item["count"],
+                "avg": item["sum"] / item["count"] if item["count"] else None,
+                "p50": estimate_quantile(item, 0.5),
+                "p99": estimate_quantile(item, 0.99),
+            }
+            for item in snapshot["histograms"]
+        },
+    }
+
+
+# Discord REST API のレイテンシーと 429 の回数を記録する aiohttp のトレース設定
+def discord_trace_config(registry: Registry = REGISTRY) -> aiohttp.TraceConfig:
+    async def on_request_start(session, context, params):
+        context.start = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        route = re.sub(r"/\d+", "/:id", params.url.path)
+        registry.observe("discord_request_seconds", time.perf_counter() - context.start, method=params.method, route=route)
+        if params.response.status == 429:
+            registry.inc("discord_rate_limited_total", route=route)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+# 一定間隔で sleep し、予定より遅れて起きた分をイベントループの遅延として記録する
+async def monitor_loop_lag(registry: Registry, interval: float = 1.0):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        registry.set("event_loop_lag_seconds", lag)
+        registry.observe("event_loop_lag_seconds_hist", lag)
@@ -0,0 +1,35 @@
+import discord
+
+
+# 初期アイコンロールを持つ（アイコン変更待ちの）ユーザーIDと、そのギルドIDを保持する。
+# on_user_update でこの集合にいないユーザーは辞書引き1回で処理を打ち切れる
+class PendingAvatars:
+    def __init__(self):
+        self._guilds: dict[int, set[int]] = {}  # ユーザーID → ギルドIDの集合
+
+    # members は初期アイコンロールを持つメンバー全員（member_cache.members_with_role の結果）
+    def rebuild(self, guild: discord.Guild, members: list[discord.Member]):
+        for guild_ids in self._guilds.values():
+            guild_ids.discard(guild.id)
+        for member in members:
+            self._guilds.setdefault(member.id, set()).add(guild.id)
+        self._guilds = {user_id: ids for user_id, ids in self._guilds.items() if ids}
+
+    def mark(self, member: discord.Member, pending: bool):
+        if pending:
+            self._guilds.setdefault(member.id, set()).add(member.guild.id)
+        else:
+            self.discard(member.id, member.guild.id)
+
+    def discard(self, user_id: int, guild_id: int):
+        guild_ids = self._guilds.get(user_id)
+        if guild_ids is not None:
+            guild_ids.discard(guild_id)
+            if not guild_ids:
+                del self._guilds[user_id]
+
+    def guilds_for(self, user_id: int) -> set[int]:
+        return self._guilds.get(user_id, set())
+
+    def __len__(self):
+        return len(self._guilds)
@@ -0,0 +1,646 @@
+import asyncio
+import functools
+import json
+import logging
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+import discord
+from discord import ui
+
+from dm_outbox import PRIORITY_STEP
+from member_cache import get_or_fetch_member
+from metrics import REGISTRY
+from role_index import FUNNEL_STATES
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 3600
+EXPIRED_TEXT = "この質問はすでに回答済みか、時間切れです。"
+STEP_TYPES = {"inviter", "date", "yes_no"}
+YES_NO_ANSWERS = {"yes", "no"}
+
+
+# 学年判定
+def is_high_school_student(dob: datetime) -> bool:
+    today = datetime.today()
+    school_year_start = datetime(today.year, 4, 1)
+    base_year = today.year if today >= school_year_start else today.year - 1
+    age_on_april_1 = base_year - dob.year - ((dob.month, dob.day) > (4, 1))
+    return age_on_april_1 <= 17
+
+
+# 日付ステップの "reject.rule" で指定できる判定
+DATE_RULES = {
+    "high_school_age": is_high_school_student,
+}
+
+
+# questionnaire.json の質問定義を検証し、ステップIDで引ける形に変換したもの。
+# 各ステップは id / type / answer_key / prompt を持ち、任意で timeout / timeout_text / reject / next を指定する。
+# next は次のステップID（回答ごとに分岐する場合は {"yes": "...", "no": "..."}）で、null なら完了
+class QuestionnaireDefinition:
+    def __init__(self, raw: dict):
+        raw_steps = raw["steps"]
+        if not raw_steps:
+            raise ValueError("質問が1つも定義されていません")
+
+        self.steps: dict[str, dict] = {}
+        for index, raw_step in enumerate(raw_steps):
+            step = dict(raw_step)
+            step_id = step.get("id", "")
+            if not re.fullmatch(r"[a-z_]+", step_id) or step_id in self.steps:
+                raise ValueError(f"ステップIDが不正または重複しています: {step_id!r}")
+            if step.get("type") not in STEP_TYPES:
+                raise ValueError(f"{step_id}: 未対応の type です: {step.get('type')!r}")
+            for field in ("answer_key", "prompt"):
+                if not step.get(field):
+                    raise ValueError(f"{step_id}: {field} がありません")
+            # send_step と同じ置換を一度試し、{ } の誤りは読み込み時に弾く
+            try:
+                for inviter_name in (None, ""):  # 招待者を選ぶ前は None
+                    step["prompt"].format(inviter_name=inviter_name)
+            except (KeyError, IndexError, ValueError, TypeError) as e:
+                raise ValueError(f"{step_id}: prompt の {{}} が不正です（使えるのは {{inviter_name}} のみ）: {e!r}")
+            # 以下は回答を受け付けた後に初めて使われるので、誤りがあると参加者のセッションが途中で止まる
+            reject = step.get("reject")
+            if reject is not None:
+                if step["type"] == "inviter" or not isinstance(reject, dict):
+                    raise ValueError(f"{step_id}: reject は date / yes_no のステップにのみオブジェクトで指定できます")
+                if step["type"] == "date" and reject.get("rule") not in DATE_RULES:
+                    raise ValueError(f"{step_id}: 未対応の reject.rule です: {reject.get('rule')!r}")
+                if step["type"] == "yes_no" and reject.get("if") not in YES_NO_ANSWERS:
+                    raise ValueError(f"{step_id}: reject.if は yes / no のいずれかです: {reject.get('if')!r}")
+                if reject.get("role") not in FUNNEL_STATES:
+                    raise ValueError(f"{step_id}: reject.role は {' / '.join(FUNNEL_STATES)} のいずれかです: {reject.get('role')!r}")
+                if not isinstance(reject.get("text"), str) or not reject["text"]:
+                    raise ValueError(f"{step_id}: reject.text がありません")
+            timeout = step.get("timeout", DEFAULT_TIMEOUT)
+            if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+                raise ValueError(f"{step_id}: timeout は正の秒数（数値）で指定してください: {timeout!r}")
+            next_step = step.get("next")
+            if isinstance(next_step, dict):
+                answers = YES_NO_ANSWERS if step["type"] == "yes_no" else set()
+                if set(next_step) - answers:
+                    raise ValueError(f"{step_id}: next の分岐は yes_no のステップの yes / no のみです: {sorted(next_step)!r}")
+            elif next_step is not None and not isinstance(next_step, str):
+                raise ValueError(f"{step_id}: next はステップIDか分岐のオブジェクトで指定してください: {next_step!r}")
+
+            step.setdefault("timeout", DEFAULT_TIMEOUT)
+            step.setdefault("timeout_text", "時間切れです。")
+            default_next = raw_steps[index + 1]["id"] if index + 1 < len(raw_steps) else None
+            next_step = step.get("next", default_next)
+            step["next_by_answer"] = next_step if isinstance(next_step, dict) else {}
+            step["default_next"] = default_next if isinstance(next_step, dict) else next_step
+            self.steps[step_id] = step
+
+        self.first_step = raw_steps[0]["id"]
+        for step in self.steps.values():
+            for target in [step["default_next"], *step["next_by_answer"].values()]:
+                if target is not None and target not in self.steps:
+                    raise ValueError(f"{step['id']}: 存在しない次ステップです: {target!r}")
+
+    @classmethod
+    def load(cls, path: str) -> "QuestionnaireDefinition":
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def next_step(self, step_id: str, answer: str = None) -> str | None:
+        step = self.steps[step_id]
+        return step["next_by_answer"].get(answer, step["default_next"])
+
+
+def deadline_after(seconds: float) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat()
+
+
+def session_key(session: dict) -> tuple[int, int]:
+    return int(session["id"]), int(session["guild_id"])
+
+
+# 進行中の質問セッション（ステップと途中の回答）をメモリに持ち、
+# Supabaseの questionnaire_sessions テーブルに保存する。再起動後はここから再開する。
+# 同じユーザーが複数のギルドで同時に手続きできるよう、(ユーザーID, ギルドID) ごとに1セッション持つ
+class SessionStore:
+    def __init__(self, db):
+        self.db = db
+        self.sessions: dict[tuple[int, int], dict] = {}
+        self._guilds: dict[int, set[int]] = {}  # ユーザーID → セッションのあるギルドID
+
+    async def load(self) -> int:
+        result = await self.db.execute("load_sessions", lambda c: c.table("questionnaire_sessions").select("*"))
+        self.sessions = {session_key(row): row for row in result.data or []}
+        self._guilds = {}
+        for member_id, guild_id in self.sessions:
+            self._guilds.setdefault(member_id, set()).add(guild_id)
+        return len(self.sessions)
+
+    def get(self, member_id: int, guild_id: int) -> dict | None:
+        return self.sessions.get((member_id, guild_id))
+
+    def guilds_for(self, member_id: int) -> set[int]:
+        return self._guilds.get(member_id, set())
+
+    async def save(self, session: dict):
+        member_id, guild_id = session_key(session)
+        self.sessions[(member_id, guild_id)] = session
+        self._guilds.setdefault(member_id, set()).add(guild_id)
+        try:
+            await self.db.execute(
+                "save_session", lambda c: c.table("questionnaire_sessions").upsert(session, on_conflict="id,guild_id")
+            )
+        except Exception as e:
+            log.error("⚠️ セッション保存エラー: %s", e, extra={"member_id": member_id, "guild_id": guild_id, "step": session["step"]})
+
+    async def delete(self, member_id: int, guild_id: int):
+        self.sessions.pop((member_id, guild_id), None)
+        guilds = self._guilds.get(member_id)
+        if guilds is not None:
+            guilds.discard(guild_id)
+            if not guilds:
+                del self._guilds[member_id]
+        try:
+            await self.db.execute(
+                "delete_session",
+                lambda c: c.table("questionnaire_sessions").delete().eq("id", str(member_id)).eq("guild_id", str(guild_id)),
+            )
+        except Exception as e:
+            log.error("⚠️ セッション削除エラー: %s", e, extra={"member_id": member_id, "guild_id": guild_id})
+
+
+# --- 永続ビュー用の部品（custom_id から復元できるので再起動後もボタンが動く） ---
+# custom_id には回答先のギルドIDを入れる。ギルドIDのない以前の形式のボタンは、そのユーザーのセッションが1つだけなら動く
+GUILD_PREFIX = r"questionnaire:(?:(?P<guild>\d+):)?"
+
+
+def guild_from_match(match) -> int | None:
+    return int(match["guild"]) if match["guild"] else None
+
+
+class AnswerButton(ui.DynamicItem[ui.Button], template=GUILD_PREFIX + r"(?P<step>[a-z_]+):(?P<answer>yes|no)"):
+    def __init__(self, guild_id: int | None, step: str, answer: str):
+        super().__init__(ui.Button(
+            label="YES" if answer == "yes" else "NO",
+            style=discord.ButtonStyle.success if answer == "yes" else discord.ButtonStyle.danger,
+            custom_id=f"questionnaire:{guild_id}:{step}:{answer}",
+        ))
+        self.guild_id = guild_id
+        self.step = step
+        self.answer = answer
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: ui.Button, match):
+        return cls(guild_from_match(match), match["step"], match["answer"])
+
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.client.questionnaire.handle_answer(interaction, self.guild_id, self.step, self.answer)
+
+
+class InviterSelect(ui.DynamicItem[ui.Select], template=GUILD_PREFIX + r"inviter:select"):
+    def __init__(self, guild_id: int | None, options: list[discord.SelectOption] = None, placeholder: str = None,
+                 item: ui.Select = None):
+        super().__init__(item or ui.Select(
+            custom_id=f"questionnaire:{guild_id}:inviter:select",
+            placeholder=placeholder,
+            options=options,
+            max_values=1,
+            min_values=1,
+            row=0,
+        ))
+        self.guild_id = guild_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: ui.Select, match):
+        return cls(guild_from_match(match), item=item)
+
+    async def callback(self, interaction: discord.Interaction):
+        inviter_id = self.item.values[0]
+        inviter_name = next((o.label for o in self.item.options if o.value == inviter_id), inviter_id)
+        await interaction.client.questionnaire.handle_inviter(interaction, self.guild_id, inviter_id, inviter_name)
+
+
+class InviterPageButton(
+    ui.DynamicItem[ui.Button], template=GUILD_PREFIX + r"inviter:(?P<direction>prev|next):(?P<page>\d+):(?P<query>.*)"
+):
+    def __init__(self, guild_id: int | None, direction: str, page: int, query: str, disabled: bool = False):
+        super().__init__(ui.Button(
+            label="◀ 前へ" if direction == "prev" else "次へ ▶",
+            style=discord.ButtonStyle.secondary,
+            custom_id=f"questionnaire:{guild_id}:inviter:{direction}:{page}:{query}",
+            disabled=disabled,
+            row=1,
+        ))
+        self.guild_id = guild_id
+        self.page = page
+        self.query = query
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: ui.Button, match):
+        return cls(guild_from_match(match), match["direction"], int(match["page"]), match["query"])
+
+    async def callback(self, interaction: discord.Interaction):
+        guild_id, inviters = await interaction.client.questionnaire.inviters_for(interaction.user.id, self.guild_id)
+        if inviters is None:
+            await interaction.response.send_message(EXPIRED_TEXT, ephemeral=True)
+            return
+        await interaction.response.edit_message(view=build_inviter_view(guild_id, inviters, self.page, self.query))
+
+
+class InviterSearchButton(ui.DynamicItem[ui.Button], template=GUILD_PREFIX + r"inviter:search"):
+    def __init__(self, guild_id: int | None):
+        super().__init__(ui.Button(
+            label="🔍 検索", style=discord.ButtonStyle.primary, custom_id=f"questionnaire:{guild_id}:inviter:search", row=1
+        ))
+        self.guild_id = guild_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: ui.Button, match):
+        return cls(guild_from_match(match))
+
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.send_modal(InviterSearchModal(self.guild_id))
+
+
+class InviterCancelButton(ui.DynamicItem[ui.Button], template=GUILD_PREFIX + r"inviter:cancel"):
+    def __init__(self, guild_id: int | None):
+        super().__init__(ui.Button(
+            label="キャンセル", style=discord.ButtonStyle.danger, custom_id=f"questionnaire:{guild_id}:inviter:cancel", row=1
+        ))
+        self.guild_id = guild_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: ui.Button, match):
+        return cls(guild_from_match(match))
+
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.client.questionnaire.cancel(interaction, self.guild_id)
+
+
+# 名前検索用のモーダル（空欄で絞り込み解除）
+class InviterSearchModal(ui.Modal, title="招待者を検索"):
+    query = ui.TextInput(label="名前の一部", required=False, max_length=32)
+
+    def __init__(self, guild_id: int | None):
+        super().__init__()
+        self.guild_id = guild_id
+
+    async def on_submit(self, interaction: discord.Interaction):
+        guild_id, inviters = await interaction.client.questionnaire.inviters_for(interaction.user.id, self.guild_id)
+        if inviters is None:
+            await interaction.response.send_message(EXPIRED_TEXT, ephemeral=True)
+            return
+        query = str(self.query).strip()
+        if query and not any(query.casefold() in name.casefold() for _, name in inviters):
+            await interaction.response.send_message("該当する招待者がいません。", ephemeral=True)
+            return
+        await interaction.response.edit_message(view=build_inviter_view(guild_id, inviters, 0, query))
+
+
+INVITER_PAGE_SIZE = 25  # Selectの選択肢は25件まで
+
+# ページ送りと検索で全招待者から選べる招待者選択ビューを作る
+def build_inviter_view(guild_id: int, inviters: tuple[tuple[str, str], ...], page: int = 0, query: str = "") -> ui.View:
+    if query:
+        candidates = [item for item in inviters if query.casefold() in item[1].casefold()]
+    else:
+        candidates = inviters
+    page_count = max(1, -(-len(candidates) // INVITER_PAGE_SIZE))
+    page = min(page, page_count - 1)
+    start = page * INVITER_PAGE_SIZE
+    options = [
+        discord.SelectOption(label=name, value=inviter_id)
+        for inviter_id, name in candidates[start:start + INVITER_PAGE_SIZE]
+    ]
+
+    view = ui.View(timeout=None)
+    view.add_item(InviterSelect(guild_id, options, f"招待者を選択してください（{page + 1}/{page_count}）"))
+    view.add_item(InviterPageButton(guild_id, "prev", max(page - 1, 0), query, disabled=page == 0))
+    view.add_item(InviterPageButton(guild_id, "next", min(page + 1, page_count - 1), query, disabled=page >= page_count - 1))
+    view.add_item(InviterSearchButton(guild_id))
+    view.add_item(InviterCancelButton(guild_id))
+    return view
+
+
+def build_yes_no_view(guild_id: int, step: str) -> ui.View:
+    view = ui.View(timeout=None)
+    view.add_item(AnswerButton(guild_id, step, "yes"))
+    view.add_item(AnswerButton(guild_id, step, "no"))
+    return view
+
+
+DYNAMIC_ITEMS = (AnswerButton, InviterSelect, InviterPageButton, InviterSearchButton, InviterCancelButton)
+
+
+# 質問の進行をステートマシンとして扱う。各ステップの回答ごとに状態を保存し、
+# 回答待ちのコルーチンを持ち続けないので、再起動しても途中から再開できる。
+# 質問内容は QuestionnaireDefinition で与え、reload で差し替えられる。
+# セッション・順番待ち・回答中の印はすべて (ユーザーID, ギルドID) ごとに持つ
+class Questionnaire:
+    def __init__(self, bot, definition: QuestionnaireDefinition, store: SessionStore, router, outbox, role_index, inviter_rosters,
+                 store_answers, on_complete, max_active: int = 0):
+        self.bot = bot
+        self.outbox = outbox
+        self.definition = definition
+        self.store = store
+        self.router = router
+        self.role_index = role_index
+        self.inviter_rosters = inviter_rosters
+        self.store_answers = store_answers
+        self.on_complete = on_complete
+        self.max_active = max_active  # 同時に進行できるセッション数（0は無制限）
+        self.waiting: dict[tuple[int, int], discord.Member] = {}  # 上限に達している間の順番待ち（先着順）
+        self._starting: set[tuple[int, int]] = set()
+        self._promoting: set[tuple[int, int]] = set()  # 順番が来て開始を待っているメンバー
+        self._tasks: set[asyncio.Task] = set()
+        self._answering: set[tuple[int, int]] = set()  # 回答を処理中のセッション（ダブルクリックなどで重なった回答を弾く）
+        self._sweeper = None
+        # テキストで回答するステップの種類（DMReplyRouter 経由で受け取る）
+        self.text_handlers = {"date": self.handle_date}
+
+    @property
+    def active_count(self) -> int:
+        # 開始中のメンバーは保存した時点で sessions にも入るので二重に数えない
+        return len(self.store.sessions) + len(self._starting.difference(self.store.sessions)) + len(self._promoting)
+
+    # 進行中のセッションが参照しているステップが新しい定義にない場合は差し替えない
+    def reload(self, definition: QuestionnaireDefinition):
+        missing = {s["step"] for s in self.store.sessions.values()} - set(definition.steps)
+        if missing:
+            raise ValueError(f"進行中のセッションが使っているステップが定義にありません: {', '.join(sorted(missing))}")
+        self.definition = definition
+        for session in self.store.sessions.values():
+            self.route(session)
+
+    # ギルドIDのない以前の custom_id から来た回答は、そのユーザーのセッションが1つだけならそのギルドとみなす
+    def resolve_guild(self, member_id: int, guild_id: int | None) -> int | None:
+        if guild_id is not None:
+            return guild_id
+        guilds = self.store.guilds_for(member_id)
+        return next(iter(guilds)) if len(guilds) == 1 else None
+
+    def current_step(self, member_id: int, guild_id: int | None, step_type: str, step_id: str = None) -> tuple[dict | None, dict | None]:
+        guild_id = self.resolve_guild(member_id, guild_id)
+        session = self.store.get(member_id, guild_id) if guild_id is not None else None
+        if session is None:
+            return None, None
+        step = self.definition.steps.get(session["step"])
+        if step is None or step["type"] != step_type or (step_id and step["id"] != step_id):
+            return None, None
+        return session, step
+
+    # current_step と同じ確認をし、回答を受け付けたら処理が終わるまで同じセッションへの回答を受け付けない。
+    # 確認と登録の間に await を挟まないので、同時に届いた2つ目の回答は (None, None) になる。終わったら release を呼ぶ
+    def claim_step(self, member_id: int, guild_id: int | None, step_type: str, step_id: str = None) -> tuple[dict | None, dict | None]:
+        session, step = self.current_step(member_id, guild_id, step_type, step_id)
+        if session is None or session_key(session) in self._answering:
+            return None, None
+        self._answering.add(session_key(session))
+        return session, step
+
+    def release(self, session: dict):
+        self._answering.discard(session_key(session))
+
+    # 参加者のギルドと招待者一覧（招待者を選ぶステップでなければ (None, None)。終了済みのメッセージのボタンなど）
+    async def inviters_for(self, member_id: int, guild_id: int | None) -> tuple[int | None, tuple[tuple[str, str], ...] | None]:
+        session, _ = self.current_step(member_id, guild_id, "inviter")
+        if session is None:
+            return None, None
+        guild_id = int(session["guild_id"])
+        return guild_id, (await self.inviter_rosters.ensure(guild_id)).sorted_items()
+
+    async def get_member(self, session: dict) -> discord.Member | None:
+        guild = self.bot.get_guild(int(session["guild_id"]))
+        if guild is None:
+            return None
+        return await get_or_fetch_member(guild, int(session["id"]))
+
+    # 1人につきギルドごとに1セッションに限定する。進行中なら "running"、上限超過なら "queued" を返す。
+    # restart=True の場合は進行中のセッションを破棄して最初からやり直す
+    async def start(self, member: discord.Member, restart: bool = False) -> str:
+        key = (member.id, member.guild.id)
+        if key in self._starting:
+            return "running"
+        if self.store.get(*key) is not None:
+            if not restart:
+                return "running"
+            await self.store.delete(*key)
+            self.reroute(member.id)
+        if self.max_active and self.active_count >= self.max_active:
+            if key not in self.waiting:
+                self.waiting[key] = member
+                self.outbox.send(member, "現在参加手続きが混み合っています。順番が来たら自動的に質問が始まりますので、しばらくお待ちください。")
+                REGISTRY.inc("questionnaire_queued_total")
+            return "queued"
+
+        self.waiting.pop(key, None)
+        self._starting.add(key)
+        try:
+            dm = await self.outbox.get_dm(member)
+            first = self.definition.steps[self.definition.first_step]
+            if first["type"] == "inviter" and not (await self.inviter_rosters.ensure(member.guild.id)).sorted_items():
+                self.outbox.send(dm, "招待者が見つかりませんでした。管理者にお問い合わせください。")
+                return "started"
+
+            session = {
+                "id": str(member.id),
+                "guild_id": str(member.guild.id),
+                "step": first["id"],
+                "answers": {},
+                "inviter_name": None,
+                "deadline": deadline_after(first["timeout"]),
+            }
+            await self.store.save(session)
+            REGISTRY.inc("questionnaire_started_total")
+        finally:
+            self._starting.discard(key)
+        self.route(session)
+        await self.send_step(session, dm)
+        return "started"
+
+    # セッションを終了し、空いた枠で順番待ちのメンバーを開始する。
+    # 開始（DMの作成・保存・最初の質問の送信）は別タスクで行い、終了した参加者の招待リンク送信や回答保存を待たせない
+    async def end(self, member_id: int, guild_id: int):
+        await self.store.delete(member_id, guild_id)
+        self.reroute(member_id)
+        while self.waiting and (not self.max_active or self.active_count < self.max_active):
+            key = next(iter(self.waiting))
+            member = self.waiting.pop(key)
+            self._promoting.add(key)  # タスクが始まるまで枠を確保しておく
+            task = asyncio.create_task(self._promote(key, member))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _promote(self, key: tuple[int, int], member: discord.Member):
+        self._promoting.discard(key)
+        try:
+            await self.start(member)
+        except Exception as e:
+            log.exception("⚠️ 順番待ちの質問開始に失敗しました: %s", e, extra={"member_id": member.id, "guild_id": member.guild.id})
+
+    # 次の質問は送り終わるまで待ち、同じ参加者への後続の送信と順番が入れ替わらないようにする
+    async def send_step(self, session: dict, dm: discord.DMChannel):
+        step = self.definition.steps[session["step"]]
+        guild_id = int(session["guild_id"])
+        text = step["prompt"].format(inviter_name=session["inviter_name"])
+        if step["type"] == "inviter":
+            view = build_inviter_view(guild_id, (await self.inviter_rosters.ensure(guild_id)).sorted_items())
+        elif step["type"] == "yes_no":
+            view = build_yes_no_view(guild_id, step["id"])
+        else:
+            view = None
+        await self.outbox.send(dm, text, view=view, priority=PRIORITY_STEP)
+
+    # 回答を記録し、reject 条件に当たれば中断、そうでなければ次のステップへ進む
+    async def answer(self, session: dict, step: dict, dm: discord.DMChannel, value: str, rejected: bool, branch: str = None):
+        session["answers"][step["answer_key"]] = value
+        outcome = "rejected" if rejected else "answered"
+        REGISTRY.inc("questionnaire_steps_total", step=step["id"], outcome=outcome)
+        start = time.perf_counter()
+        try:
+            if rejected:
+                await self.reject(session, dm, step["reject"]["role"], step["reject"]["text"])
+                return
+
+            next_id = self.definition.next_step(step["id"], branch)
+            if next_id is None:
+                await self.finish(session, dm)
+                return
+            session["step"] = next_id
+            session["deadline"] = deadline_after(self.definition.steps[next_id]["timeout"])
+            await self.store.save(session)
+            self.route(session)
+            await self.send_step(session, dm)
+        finally:
+            # 回答を受けてから次の質問（または完了処理）を送り終えるまでの時間
+            elapsed = time.perf_counter() - start
+            REGISTRY.observe("questionnaire_step_seconds", elapsed, step=step["id"])
+            log.info("質問に回答しました: %s", step["id"], extra={
+                "member_id": session["id"], "guild_id": session["guild_id"], "step": step["id"], "outcome": outcome,
+                "elapsed_ms": round(elapsed * 1000, 1),
+            })
+
+    # テキスト回答のステップならDMの返信をこのセッションへ渡す。DMはギルドを区別できないので、
+    # 複数のギルドでテキスト回答を待っている場合は最後に質問を送ったセッションが受け取る
+    def route(self, session: dict):
+        step = self.definition.steps.get(session["step"])
+        handler = self.text_handlers.get(step["type"]) if step else None
+        if handler:
+            self.router.subscribe(int(session["id"]), functools.partial(handler, int(session["guild_id"])))
+        else:
+            self.reroute(int(session["id"]))
+
+    # テキスト回答を待っている他のギルドのセッションがあればそちらへ渡し、なければ購読を解除する
+    def reroute(self, member_id: int):
+        for guild_id in self.store.guilds_for(member_id):
+            step = self.definition.steps.get(self.store.get(member_id, guild_id)["step"])
+            handler = self.text_handlers.get(step["type"]) if step else None
+            if handler:
+                self.router.subscribe(member_id, functools.partial(handler, guild_id))
+                return
+        self.router.unsubscribe(member_id)
+
+    # 保存済みセッションを読み込み、テキスト回答待ちのものは購読を再登録する
+    async def restore(self) -> int:
+        count = await self.store.load()
+        for session in self.store.sessions.values():
+            self.route(session)
+        return count
+
+    async def reject(self, session: dict, dm: discord.DMChannel, state: str, text: str):
+        member = await self.get_member(session)
+        if member:
+            await self.role_index.apply(member, state, reason="質問で参加資格なし")
+        self.outbox.send(dm, text)
+        member_id, guild_id = session_key(session)
+        await self.end(member_id, guild_id)
+        await self.store_answers(member_id, guild_id, session["answers"])
+
+    async def finish(self, session: dict, dm: discord.DMChannel):
+        REGISTRY.inc("questionnaire_completed_total")
+        member_id, guild_id = session_key(session)
+        await self.end(member_id, guild_id)
+        member = await self.get_member(session)
+        await self.on_complete(member_id, guild_id, member, dm, session["answers"])
+
+    async def handle_inviter(self, interaction: discord.Interaction, guild_id: int | None, inviter_id: str, inviter_name: str):
+        session, step = self.claim_step(interaction.user.id, guild_id, "inviter")
+        if session is None:
+            await interaction.response.send_message(EXPIRED_TEXT, ephemeral=True)
+            return
+        try:
+            await interaction.response.send_message(f"{inviter_name} を選択しました。", ephemeral=True)
+            session["inviter_name"] = inviter_name
+            await self.answer(session, step, interaction.channel, inviter_id, rejected=False)
+        finally:
+            self.release(session)
+
+    async def cancel(self, interaction: discord.Interaction, guild_id: int | None):
+        session, step = self.claim_step(interaction.user.id, guild_id, "inviter")
+        await interaction.response.send_message("キャンセルされました。", ephemeral=True)
+        if session is not None:
+            try:
+                await self.end(*session_key(session))
+                self.outbox.send(interaction.channel, step["timeout_text"])
+            finally:
+                self.release(session)
+
+    # DMReplyRouter から渡されたテキストを日付の回答として処理する。処理した場合は True
+    async def handle_date(self, guild_id: int, message: discord.Message) -> bool:
+        if (message.author.id, guild_id) in self._answering:
+            return True  # 直前の回答を処理中に続けて送られたメッセージ
+        session, step = self.claim_step(message.author.id, guild_id, "date")
+        if session is None:
+            return False
+        try:
+            value = message.content.strip()
+            try:
+                date = datetime.strptime(value, step.get("format", "%Y-%m-%d"))
+            except ValueError:
+                self.outbox.send(message.channel, step.get("invalid_text", "入力形式が正しくありません。中断します。"))
+                await self.end(message.author.id, guild_id)
+                return True
+
+            reject = step.get("reject")
+            rejected = bool(reject) and DATE_RULES[reject["rule"]](date)
+            await self.answer(session, step, message.channel, value, rejected)
+            return True
+        finally:
+            self.release(session)
+
+    async def handle_answer(self, interaction: discord.Interaction, guild_id: int | None, step_id: str, value: str):
+        session, step = self.claim_step(interaction.user.id, guild_id, "yes_no", step_id)
+        if session is None:
+            await interaction.response.send_message(EXPIRED_TEXT, ephemeral=True)
+            return
+        try:
+            await interaction.response.send_message("はい を選択しました。" if value == "yes" else "いいえ を選択しました。", ephemeral=True)
+
+            reject = step.get("reject")
+            rejected = bool(reject) and value == reject["if"]
+            await self.answer(session, step, interaction.channel, value, rejected, branch=value)
+        finally:
+            self.release(session)
+
+    # 期限切れのセッションを定期的に片付ける（待機中のコルーチンの代わり）
+    async def expire_sessions(self):
+        now = datetime.now(timezone.utc)
+        expired = [s for s in self.store.sessions.values() if datetime.fromisoformat(s["deadline"]) <= now]
+        for session in expired:
+            member_id, guild_id = session_key(session)
+            step = self.definition.steps.get(session["step"])
+            REGISTRY.inc("questionnaire_steps_total", step=session["step"], outcome="timeout")
+            await self.end(member_id, guild_id)
+            self.outbox.send(member_id, step["timeout_text"] if step else "時間切れです。")
+
+    def start_sweeper(self, interval: float = 30.0):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop(interval))
+
+    async def _sweep_loop(self, interval: float):
+        while True:
+            try:
+                await self.expire_sessions()
+            except Exception as e:
+                log.exception("⚠️ セッションの期限切れ処理に失敗しました: %s", e)
+            await asyncio.sleep(interval)
@@ -0,0 +1,81 @@
+import logging
+
+import discord
+
+log = logging.getLogger(__name__)
+
+# ファネルで使うロール（キー → 既定のロール名）
+FUNNEL_ROLE_NAMES = {
+    "initial": "初期アイコン",
+    "explaining": "説明中",
+    "invited": "招待済み",
+    "returnee": "出戻り",
+    "ineligible": "資格無し",
+}
+
+
+# ファネルの状態ごとに付いているべきロール（キー）。ここにないファネルロールは外す
+FUNNEL_STATES = {
+    "initial": {"initial"},
+    "explaining": {"explaining"},
+    "invited": {"invited"},
+    "returnee": {"explaining", "returnee"},
+    "ineligible": {"explaining", "ineligible"},
+}
+
+
+# ギルドごとに「キー → ロールID」を保持し、イベント毎のロール名の線形探索をなくす。
+# ロールIDとロール名はギルドの設定（GuildConfigStore）から取る。
+# 解決の優先順位: 設定されたロールID → 以前に解決したID（名前変更後も追従） → ロール名
+class RoleIndex:
+    def __init__(self, configs):
+        self.configs = configs
+        self._index: dict[int, dict[str, int]] = {}
+
+    def build(self, guild: discord.Guild):
+        config = self.configs.get(guild.id)
+        by_name = {role.name: role for role in guild.roles}
+        previous = self._index.get(guild.id, {})
+        resolved = {}
+        for key, name in config.role_names.items():
+            role = None
+            for role_id in (config.role_ids.get(key), previous.get(key)):
+                if role_id and guild.get_role(role_id):
+                    role = guild.get_role(role_id)
+                    break
+            if role is None:
+                role = by_name.get(name)
+            if role:
+                resolved[key] = role.id
+            else:
+                log.warning("⚠️ ロールが見つかりません: %s（%s）", name, guild.name, extra={"guild_id": guild.id})
+        self._index[guild.id] = resolved
+
+    def get(self, guild: discord.Guild, key: str) -> discord.Role | None:
+        if guild.id not in self._index:
+            self.build(guild)
+        role_id = self._index[guild.id].get(key)
+        return guild.get_role(role_id) if role_id else None
+
+    def forget(self, guild: discord.Guild):
+        self._index.pop(guild.id, None)
+
+    # 状態に対応するロール構成を計算する（ファネル以外のロールはそのまま残す）
+    def target_roles(self, member: discord.Member, state: str) -> list[discord.Role]:
+        if member.guild.id not in self._index:
+            self.build(member.guild)
+        funnel_ids = set(self._index[member.guild.id].values())
+        roles = [r for r in member.roles if not r.is_default() and r.id not in funnel_ids]
+        for key in FUNNEL_STATES[state]:
+            role = self.get(member.guild, key)
+            if role:
+                roles.append(role)
+        return roles
+
+    # ロールの付け外しを member.edit 1回にまとめる。変更がなければリクエストしない
+    async def apply(self, member: discord.Member, state: str, reason: str = None) -> bool:
+        roles = self.target_roles(member, state)
+        if {r.id for r in roles} == {r.id for r in member.roles if not r.is_default()}:
+            return False
+        await member.edit(roles=roles, reason=reason)
+        return True
@@ -1,15 +1,46 @@
+import os
+
 from fastapi import FastAPI
 import uvicorn
-from fastapi.responses import Response
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+
+from metrics import REGISTRY, render_prometheus, summarize
+
+# イベントループの遅延がこれを超えたらヘルスチェックを失敗させる（秒）
+HEALTH_MAX_LOOP_LAG = float(os.getenv("HEALTH_MAX_LOOP_LAG", "1"))
 
 app = FastAPI()
 
+
+# ゲートウェイに接続済みで、イベントループが詰まっていなければ正常とみなす
+def check_health() -> tuple[bool, dict]:
+    gauges = {item["name"]: item["value"] for item in REGISTRY.snapshot()["gauges"] if not item["labels"]}
+    connected = bool(gauges.get("gateway_connected"))
+    loop_lag = gauges.get("event_loop_lag_seconds")
+    healthy = connected and (loop_lag is None or loop_lag <= HEALTH_MAX_LOOP_LAG)
+    return healthy, {
+        "gateway_connected": connected,
+        "gateway_latency_seconds": gauges.get("gateway_latency_seconds"),
+        "event_loop_lag_seconds": loop_lag,
+    }
+
 @app.head("/")
 async def root_head():
-    return Response(status_code=200)
+    healthy, _ = check_health()
+    return Response(status_code=200 if healthy else 503)
 @app.get("/")
-def read_root():
-    return {"message": "Server is Online."}
+async def read_root():
+    healthy, detail = check_health()
+    message = "Server is Online." if healthy else "Bot is not healthy."
+    return JSONResponse({"message": message, **detail}, status_code=200 if healthy else 503)
+
+@app.get("/metrics")
+async def read_metrics():
+    return PlainTextResponse(render_prometheus(REGISTRY.snapshot()), media_type="text/plain; version=0.0.4")
+
+@app.get("/status")
+async def read_status():
+    return summarize(REGISTRY.snapshot())
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8080)
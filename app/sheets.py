@@ -0,0 +1,48 @@
+import asyncio
+import json
+import threading
+
+import gspread
+
+from metrics import REGISTRY
+
+SCOPES = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+
+# Googleスプレッドシートへの接続を初回の出力時まで遅らせる。
+# 認証情報は環境変数のJSONからメモリ上で読み込み（一時ファイルは作らない）、
+# トークンの更新は google-auth に任せる。API呼び出しはすべてスレッドで実行する
+class SheetsClient:
+    def __init__(self, service_account_json: str | None, spreadsheet_name: str = "invites"):
+        self.service_account_json = service_account_json
+        self.spreadsheet_name = spreadsheet_name
+        self._spreadsheet = None
+        self._lock = threading.Lock()
+
+    def _open(self) -> gspread.Spreadsheet:
+        with self._lock:
+            if self._spreadsheet is None:
+                if not self.service_account_json:
+                    raise RuntimeError("環境変数 GOOGLE_SERVICE_ACCOUNT_JSON が設定されていません")
+                info = json.loads(self.service_account_json)
+                gc = gspread.service_account_from_dict(info, scopes=SCOPES)
+                self._spreadsheet = gc.open(self.spreadsheet_name)
+            return self._spreadsheet
+
+    # 表を1回のupdateで書き込む。tab_title指定時は日付付きのシートに出力し、sheet1は消さない
+    def _write_table(self, table: list[list], tab_title: str = None):
+        spreadsheet = self._open()
+        if tab_title:
+            try:
+                target = spreadsheet.worksheet(tab_title)
+                target.clear()
+            except gspread.WorksheetNotFound:
+                target = spreadsheet.add_worksheet(title=tab_title, rows=max(len(table), 1), cols=6)
+        else:
+            target = spreadsheet.sheet1
+            target.clear()
+        target.update(values=table, range_name="A1")
+
+    async def write_table(self, table: list[list], tab_title: str = None):
+        with REGISTRY.time("sheets_request_seconds", operation="write_table"):
+            await asyncio.to_thread(self._write_table, table, tab_title)
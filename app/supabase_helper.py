@@ -1,5 +1,22 @@
-import requests
+import asyncio
+import copy
+import gzip
 import json
+import logging
+
+import aiohttp
+from multidict import CIMultiDict
+import requests
+
+log = logging.getLogger(__name__)
+
+
+# JSON の本文を読む。gzip 圧縮して保存されたもの（先頭がマジックバイト）は展開してから読む
+def decode_json(body: bytes) -> dict:
+    if body[:2] == b"\x1f\x8b":
+        body = gzip.decompress(body)
+    return json.loads(body.decode("utf-8"))
+
 
 class SupabaseHelper:
     def __init__(self, url, api_key, bucket, object_name="data.json"):
@@ -19,13 +36,13 @@ class SupabaseHelper:
         try:
             response = requests.put(full_url, headers=headers, data=json.dumps(data, ensure_ascii=False).encode("utf-8"))
             if response.ok:
-                print("✅ データをSupabaseにアップロードしました")
+                log.info("✅ データをSupabaseにアップロードしました")
                 return True
             else:
-                print(f"❌ アップロード失敗: {response.status_code} {response.text}")
+                log.error("❌ アップロード失敗: %s %s", response.status_code, response.text)
                 return False
         except Exception as e:
-            print(f"❌ アップロード中にエラー: {e}")
+            log.exception("❌ アップロード中にエラー: %s", e)
             return False
 
     def download(self) -> dict:
@@ -37,11 +54,109 @@ class SupabaseHelper:
         try:
             response = requests.get(full_url, headers=headers)
             if response.ok:
-                print("✅ Supabaseからデータを取得しました")
-                return json.loads(response.content.decode("utf-8"))
+                log.info("✅ Supabaseからデータを取得しました")
+                return decode_json(response.content)
             else:
-                print(f"❌ ダウンロード失敗: {response.status_code} {response.text}")
+                log.error("❌ ダウンロード失敗: %s %s", response.status_code, response.text)
                 return {}
         except Exception as e:
-            print(f"❌ ダウンロード中にエラー: {e}")
+            log.exception("❌ ダウンロード中にエラー: %s", e)
+            return {}
+
+
+# SupabaseHelper の非同期版。HTTPセッションを使い回して接続を再利用し、
+# ETag（If-None-Match）で変更がなければ 304 を受けてメモリ上のコピーを返す。
+# compress=True にするとアップロードを gzip 圧縮する（公開URLを直接読む他のクライアントが展開に対応している場合のみ）。
+# ダウンロードはどちらの形式でも読める
+class AsyncSupabaseHelper:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, url, api_key, bucket, object_name="data.json", compress: bool = False,
+                 timeout: float = 10.0, max_retries: int = 3, pool_size: int = 4):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.bucket = bucket
+        self.object_name = object_name
+        self.compress = compress
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self._session: aiohttp.ClientSession | None = None
+        self._etag = None
+        self._cached = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self.timeout,
+                headers={"apikey": self.api_key, "Authorization": f"Bearer {self.api_key}"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # タイムアウト・接続エラー・429/5xx は指数バックオフで再試行し、(ステータス, ヘッダー, 本文) を返す
+    async def _request(self, method: str, url: str, **kwargs) -> tuple[int, CIMultiDict, bytes]:
+        session = self._get_session()
+        for attempt in range(self.max_retries):
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    body = await response.read()
+                    if response.status not in self.RETRY_STATUSES or attempt == self.max_retries - 1:
+                        return response.status, response.headers.copy(), body
+                    log.warning("⚠️ Supabase Storage %s が %s を返しました（再試行します）", method, response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries - 1:
+                    raise
+                log.warning("⚠️ Supabase Storage %s でエラー（再試行します）: %s", method, e)
+            await asyncio.sleep(2 ** attempt)
+
+    @staticmethod
+    def _encode(data: dict, compress: bool) -> bytes:
+        body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return gzip.compress(body) if compress else body
+
+    async def upload(self, data: dict) -> bool:
+        headers = {
+            "Content-Type": "application/gzip" if self.compress else "application/json",
+            "x-upsert": "true",
+        }
+        full_url = f"{self.url}/storage/v1/object/{self.bucket}/{self.object_name}"
+        try:
+            body = await asyncio.to_thread(self._encode, data, self.compress)
+            status, _, text = await self._request("PUT", full_url, headers=headers, data=body)
+            if 200 <= status < 300:
+                # 次回のダウンロードは内容が変わっているので、ETag だけ捨ててフル取得させる
+                self._etag = None
+                self._cached = None
+                log.info("✅ データをSupabaseにアップロードしました")
+                return True
+            log.error("❌ アップロード失敗: %s %s", status, text.decode("utf-8", "replace"))
+            return False
+        except Exception as e:
+            log.exception("❌ アップロード中にエラー: %s", e)
+            return False
+
+    # 返す辞書はキャッシュのコピーなので、呼び出し側で変更してよい
+    async def download(self) -> dict:
+        headers = {"If-None-Match": self._etag} if self._etag and self._cached is not None else {}
+        full_url = f"{self.url}/storage/v1/object/public/{self.bucket}/{self.object_name}"
+        try:
+            status, response_headers, body = await self._request("GET", full_url, headers=headers)
+            if status == 304:
+                return copy.deepcopy(self._cached)
+            if 200 <= status < 300:
+                data = await asyncio.to_thread(decode_json, body)
+                self._etag = response_headers.get("ETag")
+                self._cached = data
+                log.info("✅ Supabaseからデータを取得しました")
+                return copy.deepcopy(data)
+            log.error("❌ ダウンロード失敗: %s %s", status, body.decode("utf-8", "replace"))
+            return {}
+        except Exception as e:
+            log.exception("❌ ダウンロード中にエラー: %s", e)
             return {}
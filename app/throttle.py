@@ -0,0 +1,46 @@
+import asyncio
+
+
+# 一定の間隔（1秒あたり rate 回）でしか処理を通さないペースメーカー。
+# 複数のワーカーで共有すると、全体のリクエスト頻度をDiscordのレート制限以下に抑えられる
+class Pacer:
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next_at = 0.0
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        at = max(now, self._next_at)
+        self._next_at = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+
+# items を concurrency 個のワーカーで処理する。worker は1件ごとに呼ばれ、
+# 戻り値（True/False）で成功・スキップを返す。例外は失敗として (item, 例外) を集める
+async def run_throttled(items, worker, concurrency: int, pacer: Pacer) -> tuple[int, int, list]:
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+    done = 0
+    skipped = 0
+    failed = []
+
+    async def run_worker():
+        nonlocal done, skipped
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                if await worker(item, pacer):
+                    done += 1
+                else:
+                    skipped += 1
+            except Exception as e:
+                failed.append((item, e))
+
+    await asyncio.gather(*(run_worker() for _ in range(max(1, concurrency))))
+    return done, skipped, failed
@@ -0,0 +1,207 @@
+# メンバーキャッシュの方針（MEMBER_CACHE / CHUNK_GUILDS_AT_STARTUP）ごとの、起動時間とメモリのオフライン計測。
+# discord.py の ConnectionState に偽の GUILD_MEMBERS_CHUNK / GUILD_MEMBER_UPDATE を流し込み、
+# ギルドの人数ごとに「チャンクの処理時間・on_ready までの目安・キャッシュしたメンバー数・RSSの増分」と、
+# 遅延取得に切り替えた場合に増えるリクエスト（定期の走査・起動時の照会）を出す。
+#
+#   python benchmark/member_cache.py                       # 1000 / 10000 / 100000 人
+#   python benchmark/member_cache.py --scales 50000 --active 0.05 --json
+#
+# all+chunk が従来の設定、joined+lazy が MEMBER_CACHE=joined CHUNK_GUILDS_AT_STARTUP=0 に当たる。
+# joined+lazy では初期アイコンロール・招待者ロールを持つメンバーを走査で見つけて query_members でキャッシュに入れ、
+# それ以外はイベントが届いたメンバー（--active の割合）だけがキャッシュに入る
+import argparse
+import asyncio
+import gc
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import discord
+from discord.state import ChunkRequest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+
+from member_cache import member_cache_flags  # noqa: E402
+
+GUILD_ID = 1361763625953398945
+INVITER_ROLE_ID = 1373499098359136256
+FUNNEL_ROLE_IDS = [101, 102, 103, 104, 105]
+CHUNK_SIZE = 1000  # GUILD_MEMBERS_CHUNK 1回あたりの最大人数
+PAGE_SIZE = 1000  # メンバー一覧API 1回あたりの最大人数
+QUERY_BATCH_SIZE = 100  # query_members 1回あたりの最大人数
+
+# (名前, MEMBER_CACHE, 起動時にチャンクするか)
+MODES = [
+    ("all+chunk", "all", True),
+    ("joined+lazy", "joined", False),
+]
+
+
+def rss_kb() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def member_payload(member_id: int, inviter: bool, pending: bool = False) -> dict:
+    roles = [str(FUNNEL_ROLE_IDS[0] if pending else random.choice(FUNNEL_ROLE_IDS[1:]))]
+    if inviter:
+        roles.append(str(INVITER_ROLE_ID))
+    return {
+        "user": {
+            "id": str(member_id),
+            "username": f"user{member_id}",
+            "global_name": f"ユーザー{member_id % 100000}",
+            "discriminator": "0",
+            "avatar": None if member_id % 5 == 0 else f"{member_id:032x}",
+            "public_flags": 0,
+        },
+        "roles": roles,
+        "nick": None,
+        "avatar": None,
+        "joined_at": "2025-01-01T00:00:00+00:00",
+        "premium_since": None,
+        "deaf": False,
+        "mute": False,
+        "pending": False,
+        "flags": 0,
+    }
+
+
+def guild_payload(scale: int) -> dict:
+    roles = [{"id": str(GUILD_ID), "name": "@everyone", "permissions": "0", "position": 0}]
+    roles += [{"id": str(role_id), "name": f"role{role_id}", "permissions": "0", "position": 1} for role_id in FUNNEL_ROLE_IDS]
+    roles.append({"id": str(INVITER_ROLE_ID), "name": "招待者", "permissions": "0", "position": 2})
+    return {"id": str(GUILD_ID), "name": "benchmark", "owner_id": "1", "member_count": scale, "large": True, "roles": roles}
+
+
+def run_child(args):
+    random.seed(0)
+    mode, cache, chunk = next(m for m in MODES if m[0] == args.mode)
+    intents = discord.Intents.default()
+    intents.members = True
+
+    async def run() -> dict:
+        client = discord.Client(intents=intents, member_cache_flags=member_cache_flags(cache, intents), chunk_guilds_at_startup=chunk)
+        state = client._connection
+        guild = discord.Guild(data=guild_payload(args.scale), state=state)
+        state._add_guild(guild)
+        inviters = set(random.sample(range(1, args.scale + 1), min(args.inviters, args.scale)))
+        pending = set(random.sample(range(1, args.scale + 1), int(args.scale * args.pending)))  # 初期アイコンロール
+        gc.collect()
+        baseline = rss_kb()
+        started = time.perf_counter()
+
+        chunks = 0
+        if chunk:
+            # 起動時のチャンク。Discord は 1000 人ずつ返し、すべて届くまで on_ready は呼ばれない
+            request = ChunkRequest(guild.id, 0, state.loop, state._get_guild, cache=True)
+            state._chunk_requests[request.nonce] = request
+            chunks = math.ceil(args.scale / CHUNK_SIZE)
+            for index in range(chunks):
+                first = index * CHUNK_SIZE + 1
+                members = [member_payload(i, i in inviters, i in pending) for i in range(first, min(first + CHUNK_SIZE, args.scale + 1))]
+                state.parse_guild_members_chunk({
+                    "guild_id": str(guild.id), "members": members,
+                    "chunk_index": index, "chunk_count": chunks, "nonce": request.nonce,
+                })
+        else:
+            # 遅延取得。起動時の走査で見つけた初期アイコンロール・招待者ロールのメンバーを query_members と同じ経路でキャッシュに入れる
+            tracked = sorted(inviters | pending)
+            queries = math.ceil(len(tracked) / QUERY_BATCH_SIZE)
+            for index in range(queries):
+                request = ChunkRequest(guild.id, 0, state.loop, state._get_guild, cache=True)
+                state._chunk_requests[request.nonce] = request
+                batch = tracked[index * QUERY_BATCH_SIZE:(index + 1) * QUERY_BATCH_SIZE]
+                state.parse_guild_members_chunk({
+                    "guild_id": str(guild.id), "members": [member_payload(i, i in inviters, i in pending) for i in batch],
+                    "chunk_index": 0, "chunk_count": 1, "nonce": request.nonce,
+                })
+            # 以後はイベントが届いたメンバー（参加・ロール変更など）がキャッシュに入る
+            active = random.sample(range(1, args.scale + 1), int(args.scale * args.active))
+            for member_id in active:
+                data = member_payload(member_id, member_id in inviters, member_id in pending)
+                state.parse_guild_member_update({"guild_id": str(guild.id), **data})
+        parse_seconds = time.perf_counter() - started
+
+        gc.collect()
+        result = {
+            "scale": args.scale,
+            "mode": mode,
+            "cached_members": len(guild.members),
+            "parse_ms": round(parse_seconds * 1000, 1),
+            # チャンクの受信待ち（1回あたり chunk_latency）を足した on_ready までの目安
+            "ready_s": round(parse_seconds + chunks * args.chunk_latency, 2),
+            "rss_delta_mb": round((rss_kb() - baseline) / 1024, 1),
+            # チャンクしない場合は起動時と AVATAR_RECONCILE_INTERVAL ごとにメンバー一覧APIを1回走査する
+            # （初期アイコンロールと招待者ロールをまとめて振り分けるので、走査は1回で済む）
+            "list_requests_per_sync": 0 if chunk else math.ceil(args.scale / PAGE_SIZE),
+            "list_requests_per_hour": 0 if chunk else round(math.ceil(args.scale / PAGE_SIZE) * 3600 / args.sync_interval),
+            # 起動時に追跡対象をキャッシュに入れるゲートウェイの照会（以後は新たに見つかった人の分だけ）
+            "startup_queries": 0 if chunk else math.ceil(len(inviters | pending) / QUERY_BATCH_SIZE),
+            # ボットの外でロールを付けられたメンバーに気づくまでの最大秒数（追跡対象のアイコン変更・ロール変更は即時）
+            "role_detect_max_s": 0 if chunk else args.sync_interval,
+        }
+        await client.close()
+        return result
+
+    print(json.dumps(asyncio.run(run()), ensure_ascii=False))
+
+
+COLUMNS = [
+    ("scale", "人数"), ("mode", "方針"), ("cached_members", "キャッシュ人数"), ("parse_ms", "処理ms"),
+    ("ready_s", "起動目安s"), ("rss_delta_mb", "RSS増分MB"), ("list_requests_per_sync", "一覧取得/走査"),
+    ("list_requests_per_hour", "一覧取得/時"), ("startup_queries", "起動時照会"), ("role_detect_max_s", "ロール検知最大s"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="メンバーキャッシュの方針ごとの起動時間とメモリの計測")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000], help="ギルドの人数")
+    parser.add_argument("--modes", nargs="+", default=[m[0] for m in MODES], choices=[m[0] for m in MODES])
+    parser.add_argument("--inviters", type=int, default=200, help="招待者ロールを持つ人数")
+    parser.add_argument("--pending", type=float, default=0.01, help="初期アイコンロールを持つメンバーの割合")
+    parser.add_argument("--active", type=float, default=0.02, help="起動後にイベントが届く（キャッシュに入る）メンバーの割合")
+    parser.add_argument("--sync-interval", type=float, default=600, help="AVATAR_RECONCILE_INTERVAL（秒）")
+    parser.add_argument("--chunk-latency", type=float, default=0.1, help="GUILD_MEMBERS_CHUNK 1回の受信待ち（秒）")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    parser.add_argument("--scale", type=int, help=argparse.SUPPRESS)  # 子プロセス用
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scale is not None:
+        run_child(args)
+        return
+
+    # RSS を比べられるよう、人数と方針の組ごとに別プロセスで測る
+    results = []
+    options = [
+        "--inviters", str(args.inviters), "--pending", str(args.pending), "--active", str(args.active),
+        "--chunk-latency", str(args.chunk_latency), "--sync-interval", str(args.sync_interval),
+    ]
+    for scale in args.scales:
+        for mode in args.modes:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--scale", str(scale), "--mode", mode, *options],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    print("  ".join(label for _, label in COLUMNS))
+    for result in results:
+        print("  ".join(str(result[key]) for key, _ in COLUMNS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+# 参加手続き（on_member_join → 質問 → 回答保存 → 招待リンク送信）のオフライン負荷試験。
+# Discord は偽のクライアント、Supabase はローカルの偽 PostgREST、スプレッドシートは偽のワークシートで置き換え、
+# 同時参加数ごとにスループット・ステップ遅延（p50/p99）・イベントループの遅延・参加者1人あたりのリクエスト数を出す。
+#
+#   python benchmark/onboarding.py                    # 10 / 100 / 1000 人
+#   python benchmark/onboarding.py --scales 100 --paced --json
+#
+# 既定ではDM送信のペース制御を外してボット側の処理だけを測る。--paced で本番と同じ DM_RATE を使う
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from aiohttp import web
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+GUILD_ID = 1361763625953398945
+INVITER_ROLE_ID = 1373499098359136256
+INVITE_CHANNEL_ID = 2000
+INVITE_MESSAGE_ID = 2001
+FUNNEL_ROLE_IDS = {"initial": 101, "explaining": 102, "invited": 103, "returnee": 104, "ineligible": 105}
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# ---- Supabase（PostgREST）の代わり。別スレッドのイベントループで動かし、ボットのループの計測を汚さない ----
+
+class FakePostgREST:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = Counter()
+        self.port = None
+        self._ready = threading.Event()
+        self._loop = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        table = request.match_info["table"]
+        self.requests[f"{request.method} {table}"] += 1
+        await asyncio.sleep(self.latency)
+        if request.method in ("POST", "PATCH"):
+            body = await request.json()
+            if table == "rpc/invite_summary":
+                rows = [
+                    {"invite_method": m, "gender": g, "settled": s, "count": random.randint(0, 50)}
+                    for m in ("Twitter", "Discord", "その他") for g in ("男性", "女性") for s in (True, False)
+                ]
+                return web.json_response(rows)
+            return web.json_response(body if isinstance(body, list) else [body], status=201)
+        return web.json_response([])
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_route("*", "/rest/v1/{table:.+}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    def start(self) -> str:
+        threading.Thread(target=self._run, daemon=True).start()
+        self._ready.wait()
+        return f"http://127.0.0.1:{self.port}"
+
+
+# ---- Discord の代わり。REST 呼び出しにあたる操作で遅延を入れ、ルートごとに回数を数える ----
+
+class FakeHTTP:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = Counter()
+
+    async def call(self, route: str):
+        self.requests[route] += 1
+        await asyncio.sleep(self.latency)
+
+
+class FakeRole:
+    def __init__(self, role_id: int, name: str, guild):
+        self.id = role_id
+        self.name = name
+        self.guild = guild
+        self.members = []
+
+    def is_default(self) -> bool:
+        return self.id == self.guild.id
+
+
+class FakeGuild:
+    def __init__(self, http: FakeHTTP, role_names: dict[str, str]):
+        self.http = http
+        self.id = GUILD_ID
+        self.name = "benchmark"
+        self._roles = {self.id: FakeRole(self.id, "@everyone", self)}
+        for key, role_id in FUNNEL_ROLE_IDS.items():
+            self._roles[role_id] = FakeRole(role_id, role_names[key], self)
+        self._roles[INVITER_ROLE_ID] = FakeRole(INVITER_ROLE_ID, "招待者", self)
+        self.members: dict[int, "FakeMember"] = {}
+        self.chunked = True  # 全メンバーを持っている（起動時にチャンクした状態）
+
+    @property
+    def roles(self):
+        return list(self._roles.values())
+
+    def get_role(self, role_id: int):
+        return self._roles.get(role_id)
+
+    def get_member(self, member_id: int):
+        return self.members.get(member_id)
+
+    async def fetch_member(self, member_id: int):
+        await self.http.call("GET /guilds/:id/members/:id")
+        return self.members[member_id]
+
+
+class FakeMessage:
+    def __init__(self, channel, content: str, author=None):
+        self.channel = channel
+        self.content = content
+        self.author = author
+
+
+class FakeDMChannel:
+    def __init__(self, http: FakeHTTP, recipient):
+        self.http = http
+        self.recipient = recipient
+        self.messages: list[str] = []
+
+    async def send(self, content=None, **kwargs):
+        await self.http.call("POST /channels/:id/messages")
+        self.messages.append(content)
+        return FakeMessage(self, content)
+
+
+class FakeMember:
+    def __init__(self, http: FakeHTTP, guild: FakeGuild, member_id: int):
+        self.http = http
+        self.guild = guild
+        self.id = member_id
+        self.display_name = f"applicant-{member_id}"
+        self.avatar = "avatar"
+        self.bot = False
+        self.dm_channel = None
+        self.roles = [guild.get_role(guild.id)]
+
+    def get_role(self, role_id: int):
+        return next((r for r in self.roles if r.id == role_id), None)
+
+    async def create_dm(self):
+        await self.http.call("POST /users/@me/channels")
+        self.dm_channel = FakeDMChannel(self.http, self)
+        return self.dm_channel
+
+    async def edit(self, roles=None, reason=None):
+        await self.http.call("PATCH /guilds/:id/members/:id")
+        self.roles = [self.guild.get_role(self.guild.id), *roles]
+
+    def __str__(self):
+        return self.display_name
+
+
+class FakeResponse:
+    async def send_message(self, *args, **kwargs):
+        pass  # インタラクションへの応答（ボタン押下の確認）は本番でも1リクエストだが、遅延は測らない
+
+
+class FakeInteraction:
+    def __init__(self, member: FakeMember):
+        self.user = member
+        self.channel = member.dm_channel
+        self.response = FakeResponse()
+
+
+class FakeInvite:
+    code = "benchmark"
+
+
+class FakeChannel:
+    def __init__(self, http: FakeHTTP):
+        self.http = http
+
+    async def fetch_message(self, message_id: int):
+        await self.http.call("GET /channels/:id/messages/:id")
+        return FakeMessage(self, "参加はこちらから https://discord.gg/benchmark")
+
+
+# ---- gspread の代わり（エクスポートコマンド用）。呼び出しはスレッドで行われるので time.sleep で遅延させる ----
+
+class FakeWorksheet:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+        self.values = []
+
+    def clear(self):
+        self.calls["clear"] += 1
+        time.sleep(self.latency)
+
+    def update(self, values=None, range_name=None):
+        self.calls["update"] += 1
+        time.sleep(self.latency)
+        self.values = values
+
+
+class FakeSpreadsheet:
+    def __init__(self, latency: float):
+        self.sheet1 = FakeWorksheet(latency)
+
+    def worksheet(self, title):
+        return self.sheet1
+
+    def add_worksheet(self, title, rows, cols):
+        return self.sheet1
+
+
+class FakeContext:
+    async def send(self, *args, **kwargs):
+        pass
+
+
+# ---- 1つの同時参加数での計測（子プロセスで実行） ----
+
+def configure_env(args, db_url: str, journal_dir: str):
+    os.environ.update({
+        "DISCORD_TOKEN": "benchmark",
+        "SUPABASE_URL": db_url,
+        "SUPABASE_API_KEY": "eyJhbGciOiJIUzI1NiJ9.e30.benchmark",
+        "INVITE_URL": f"https://discord.com/channels/{GUILD_ID}/{INVITE_CHANNEL_ID}/{INVITE_MESSAGE_ID}",
+        "ANSWER_JOURNAL_PATH": os.path.join(journal_dir, "answers_journal.jsonl"),
+        "INVITER_GUILD_ID": str(GUILD_ID),
+        "INVITER_ROLE_ID": str(INVITER_ROLE_ID),
+        **{f"ROLE_ID_{key.upper()}": str(role_id) for key, role_id in FUNNEL_ROLE_IDS.items()},
+    })
+    if not args.paced:
+        os.environ.update({"DM_RATE": "0"})
+
+
+async def answer_all(app, member: FakeMember, step_latencies: list[float], think_time: float):
+    questionnaire = app.questionnaire
+    key = (member.id, member.guild.id)
+    while True:
+        session = questionnaire.store.get(*key)
+        if session is None:
+            # MAX_ACTIVE_SESSIONS で順番待ちになった参加者は、質問が始まるまで待つ
+            if key in questionnaire.waiting or key in questionnaire._promoting or key in questionnaire._starting:
+                await asyncio.sleep(0.01)
+                continue
+            return
+        step = questionnaire.definition.steps[session["step"]]
+        if think_time:
+            await asyncio.sleep(random.uniform(0, think_time))
+        start = time.perf_counter()
+        if step["type"] == "inviter":
+            await questionnaire.handle_inviter(FakeInteraction(member), member.guild.id, "1", "inviter-1")
+        elif step["type"] == "date":
+            # 本番と同じく DMReplyRouter を通す（どのギルドのセッションに渡すかはルーターが決める）
+            await app.dm_router.dispatch(FakeMessage(member.dm_channel, "1990-01-01", author=member))
+        else:
+            reject = step.get("reject")
+            value = "no" if reject and reject["if"] == "yes" else "yes"
+            await questionnaire.handle_answer(FakeInteraction(member), member.guild.id, step["id"], value)
+        step_latencies.append(time.perf_counter() - start)
+
+
+async def run_scale(args, postgrest: FakePostgREST) -> dict:
+    import bot as app  # 環境変数を設定してから読み込む
+    from role_index import FUNNEL_ROLE_NAMES
+
+    http = FakeHTTP(args.discord_latency)
+    guild = FakeGuild(http, FUNNEL_ROLE_NAMES)
+    inviter = FakeMember(http, guild, 1)
+    inviter.roles.append(guild.get_role(INVITER_ROLE_ID))
+    guild.get_role(INVITER_ROLE_ID).members.append(inviter)
+    guild.members[inviter.id] = inviter
+
+    async def fetch_invite(url):
+        await http.call("GET /invites/:code")
+        return FakeInvite()
+
+    async def fetch_user(user_id):
+        await http.call("GET /users/:id")
+        return guild.members[user_id]
+
+    app.bot.get_guild = lambda guild_id: guild if guild_id == GUILD_ID else None
+    app.bot.get_user = lambda user_id: guild.members.get(user_id)
+    app.bot.fetch_user = fetch_user
+    app.bot.get_channel = lambda channel_id: FakeChannel(http)
+    app.bot.fetch_invite = fetch_invite
+    app.sheets._spreadsheet = FakeSpreadsheet(args.sheets_latency)
+
+    await app.setup_hook()
+    app.role_index.build(guild)
+    app.inviter_rosters.for_guild(guild.id)
+    await app.invite_caches.for_guild(guild.id).get()
+
+    loop = asyncio.get_running_loop()
+    lags = []
+
+    async def sample_lag(interval: float = 0.01):
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lags.append(max(0.0, loop.time() - start - interval))
+
+    members = [FakeMember(http, guild, 10_000 + i) for i in range(args.scale)]
+    for member in members:
+        guild.members[member.id] = member
+    join_latencies, step_latencies = [], []
+
+    async def applicant(member: FakeMember):
+        start = time.perf_counter()
+        await app.on_member_join(member)
+        join_latencies.append(time.perf_counter() - start)
+        await answer_all(app, member, step_latencies, args.think_time)
+
+    http.requests.clear()
+    postgrest.requests.clear()
+    sampler = asyncio.create_task(sample_lag())
+    start = time.perf_counter()
+    await asyncio.gather(*(applicant(m) for m in members))
+    # 招待リンクは投げっぱなしで送られるので、全員に届くまで待つ
+    # （順番待ちの案内は優先度が最も低く、招待リンクより後に届くことがある）
+    while not all(m.dm_channel and any("discord.gg" in message for message in m.dm_channel.messages) for m in members):
+        await asyncio.sleep(0.01)
+    await app.answer_buffer.flush()
+    elapsed = time.perf_counter() - start
+
+    export_start = time.perf_counter()
+    await app.run_invite_summary(FakeContext(), "export_invite_summary", "benchmark", "2000-01-01", None, "sheets", None)
+    export_elapsed = time.perf_counter() - export_start
+    sampler.cancel()
+
+    completed = sum(1 for m in members if m.get_role(FUNNEL_ROLE_IDS["invited"]))
+    return {
+        "scale": args.scale,
+        "completed": completed,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(completed / elapsed, 2),
+        "join_p50_ms": round(percentile(join_latencies, 0.5) * 1000, 1),
+        "join_p99_ms": round(percentile(join_latencies, 0.99) * 1000, 1),
+        "step_p50_ms": round(percentile(step_latencies, 0.5) * 1000, 1),
+        "step_p99_ms": round(percentile(step_latencies, 0.99) * 1000, 1),
+        "loop_lag_p99_ms": round(percentile(lags, 0.99) * 1000, 1),
+        "loop_lag_max_ms": round(max(lags, default=0.0) * 1000, 1),
+        "discord_requests_per_applicant": round(sum(http.requests.values()) / args.scale, 2),
+        "supabase_requests_per_applicant": round(sum(postgrest.requests.values()) / args.scale, 2),
+        "discord_requests": dict(http.requests),
+        "supabase_requests": dict(postgrest.requests),
+        "export_ms": round(export_elapsed * 1000, 1),
+    }
+
+
+def run_child(args):
+    postgrest = FakePostgREST(args.db_latency)
+    db_url = postgrest.start()
+    with tempfile.TemporaryDirectory() as journal_dir:
+        configure_env(args, db_url, journal_dir)
+        sys.path.insert(0, APP_DIR)
+        from json_logging import parse_sample_rates, setup_logging
+
+        # ボットのログは本番と同じパイプラインを通して捨てる（整形・出力のコストは計測に含まれる）
+        devnull = open(os.devnull, "w")
+        setup_logging(os.getenv("LOG_LEVEL", "INFO"), parse_sample_rates(os.getenv("LOG_SAMPLE", "")), stream=devnull)
+        result = asyncio.run(run_scale(args, postgrest))
+    print(json.dumps(result, ensure_ascii=False))
+
+
+COLUMNS = [
+    ("scale", "人数"), ("throughput_per_s", "完了/秒"), ("join_p50_ms", "参加p50"), ("join_p99_ms", "参加p99"),
+    ("step_p50_ms", "回答p50"), ("step_p99_ms", "回答p99"), ("loop_lag_p99_ms", "ループ遅延p99"),
+    ("loop_lag_max_ms", "最大"), ("discord_requests_per_applicant", "Discord/人"),
+    ("supabase_requests_per_applicant", "Supabase/人"), ("export_ms", "集計出力"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="参加手続きのオフライン負荷試験")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10, 100, 1000], help="同時参加数")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Discord REST 1回の遅延（秒）")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="Supabase 1回の遅延（秒）")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="スプレッドシート API 1回の遅延（秒）")
+    parser.add_argument("--think-time", type=float, default=0.0, help="参加者が回答するまでの最大待ち時間（秒）")
+    parser.add_argument("--paced", action="store_true", help="DM送信のペース制御を本番どおりに有効にする")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    parser.add_argument("--scale", type=int, help=argparse.SUPPRESS)  # 子プロセス用
+    args = parser.parse_args()
+
+    if args.scale is not None:
+        run_child(args)
+        return
+
+    # ボットの状態（キャッシュ・セッション）を持ち越さないよう、人数ごとに別プロセスで測る
+    results = []
+    options = [
+        "--discord-latency", str(args.discord_latency), "--db-latency", str(args.db_latency),
+        "--sheets-latency", str(args.sheets_latency), "--think-time", str(args.think_time),
+        *(["--paced"] if args.paced else []),
+    ]
+    for scale in args.scales:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--scale", str(scale), *options],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    print("  ".join(label for _, label in COLUMNS))
+    for result in results:
+        print("  ".join(str(result[key]) for key, _ in COLUMNS))
+
+
+if __name__ == "__main__":
+    main()
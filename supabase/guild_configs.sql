@@ -0,0 +1,12 @@
+-- ギルドごとの設定。null の項目はボットの環境変数の既定値を使う
+create table if not exists guild_configs (
+    guild_id text primary key,
+    role_ids jsonb not null default '{}'::jsonb,    -- {"initial": "...", "explaining": "...", ...}
+    role_names jsonb not null default '{}'::jsonb,  -- ロールIDがない場合に探すロール名
+    inviter_guild_id text,
+    inviter_role_id text,
+    invite_url text,
+    admin_user_id text,
+    admin_channel_id text,
+    updated_at timestamptz not null default now()
+);
@@ -0,0 +1,18 @@
+-- 招待集計用RPC。export_invite_summary* から呼び出され、グループごとの件数のみを返す
+create or replace function invite_summary(since timestamptz, until timestamptz default null)
+returns table (invite_method text, gender text, settled boolean, count bigint)
+language sql
+stable
+as $$
+    select
+        i.invite_method,
+        i.gender,
+        coalesce(i.settled, false) as settled,
+        count(*) as count
+    from invites i
+    where i.invited_at >= since
+      and (until is null or i.invited_at <= until)
+    group by 1, 2, 3;
+$$;
+
+create index if not exists invites_invited_at_idx on invites (invited_at);
@@ -0,0 +1,16 @@
+-- 進行中の質問セッション。ボットの再起動後にここから再開する。
+-- 同じユーザーが複数のサーバーで同時に手続きできるよう、(ユーザーID, ギルドID) ごとに1行
+create table if not exists questionnaire_sessions (
+    id text not null,
+    guild_id text not null,
+    step text not null,
+    answers jsonb not null default '{}'::jsonb,
+    inviter_name text,
+    deadline timestamptz not null,
+    updated_at timestamptz not null default now(),
+    primary key (id, guild_id)
+);
+
+-- ユーザーIDだけを主キーにしていた既存のテーブルを移行する
+alter table questionnaire_sessions drop constraint if exists questionnaire_sessions_pkey;
+alter table questionnaire_sessions add primary key (id, guild_id);
@@ -0,0 +1,5 @@
+-- 質問への回答は (ユーザーID, ギルドID) ごとに1行にする（別のサーバーでの回答で上書きしない）。
+-- 以前の行はどのサーバーの回答か分からないので guild_id は空文字になる
+alter table responses add column if not exists guild_id text not null default '';
+alter table responses drop constraint if exists responses_pkey;
+alter table responses add primary key (id, guild_id);